@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+#  -*- coding: utf-8 -*-
+"""
+Compare the throughput of the csv readers on a Minint file.
+
+Usage, from the root of the repository:
+
+    python -m benchmarks.bench_reader ammcom.zip [--repeat N]
+
+The file can be the zip archive or the extracted txt.
+"""
+
+import argparse
+import csv
+import io
+import time
+import zipfile
+from utils import DictReaderInsensitive, FastDictReaderInsensitive
+
+__author__ = 'guglielmo'
+
+
+def read_text(path, skip_lines=2):
+    """
+    Read the Minint file in memory, without the lines of notes,
+    so that only the csv parsing is timed.
+    """
+    if zipfile.is_zipfile(path):
+        archive = zipfile.ZipFile(path)
+        content = archive.read(archive.infolist()[0].filename)
+    else:
+        with open(path, 'rb') as f:
+            content = f.read()
+    lines = content.decode('latin1').split("\r\n")[skip_lines:]
+    return "\n".join(lines)
+
+
+def bench(reader_class, text, repeat):
+    """
+    :return: tuple (rows, best rows/s over the repetitions)
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        n = 0
+        for row in reader_class(io.StringIO(text), delimiter=";"):
+            n += 1
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return n, n / best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the Minint csv readers.')
+    parser.add_argument('path', help='Minint zip archive or txt file.')
+    parser.add_argument('--skip_lines', type=int, default=2,
+        help='Lines of notes preceding the header (0 for the storici files).')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    text = read_text(args.path, args.skip_lines)
+    for reader_class in (csv.DictReader, DictReaderInsensitive, FastDictReaderInsensitive):
+        rows, rate = bench(reader_class, text, args.repeat)
+        print("{0:<28} {1:>8} rows {2:>12,.0f} rows/s".format(reader_class.__name__, rows, rate))
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+#  -*- coding: utf-8 -*-
+"""
+A minimal stand-in for an ElasticSearch node, good enough for the storers:
+it acknowledges index administration requests and answers _bulk requests
+with a successful item for each action, without storing anything.
+
+Failures can be scripted, for the tests: error statuses for the next
+_bulk requests, and for the items of given _ids, in the order they come.
+The _ids of the actions received can then be listed:
+
+    stub.script(responses=[503], items={'an-id': [429, 400]})
+    ... stub.received() ...
+
+It runs in a separate process, so that it doesn't compete for the GIL
+with the code being measured:
+
+    stub = ESStub()
+    stub.start()
+    ... stub.url ...
+    stub.stop()
+"""
+
+import gzip
+import http.server
+import json
+import multiprocessing
+import threading
+import urllib.request
+
+__author__ = 'guglielmo'
+
+
+# errors of the statuses scripted
+ERRORS = {
+    400: {'type': 'mapper_parsing_exception', 'reason': 'failed to parse'},
+    429: {'type': 'es_rejected_execution_exception', 'reason': 'rejected execution'},
+}
+
+
+class ESStubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    # scripted failures, and the _ids of the actions of each _bulk request
+    # received since, shared by the threads serving the requests
+    lock = threading.Lock()
+    scripted_responses = []
+    scripted_items = {}
+    received = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        return body
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        if self.path == '/_stub':
+            return self.send_json({'received': ESStubHandler.received})
+        self.send_json({})
+
+    def do_PUT(self):
+        self.read_body()
+        self.send_json({'acknowledged': True})
+
+    def do_DELETE(self):
+        self.send_json({'acknowledged': True})
+
+    def do_POST(self):
+        body = self.read_body()
+        if self.path == '/_stub':
+            return self.script(json.loads(body))
+        if not self.path.split('?')[0].endswith('_bulk'):
+            return self.send_json({'acknowledged': True})
+        if ESStubHandler.received is not None:
+            return self.scripted_bulk(body)
+
+        # action lines are the only ones starting with one of the action names,
+        # a source line never does: no need to parse the documents
+        items = []
+        expect_source = False
+        for line in body.split(b'\n'):
+            if not line:
+                continue
+            if expect_source:
+                expect_source = False
+                continue
+            action = line[2:line.index(b'"', 2)].decode('ascii')
+            items.append({action: {'status': 200 if action == 'delete' else 201}})
+            expect_source = action in ('index', 'create', 'update')
+        self.send_json({'took': 1, 'errors': False, 'items': items})
+
+    def script(self, script):
+        with ESStubHandler.lock:
+            ESStubHandler.scripted_responses = list(script.get('responses', []))
+            ESStubHandler.scripted_items = dict(script.get('items', {}))
+            ESStubHandler.received = []
+        self.send_json({'acknowledged': True})
+
+    def scripted_bulk(self, body):
+        lines = iter(json.loads(line) for line in body.split(b'\n') if line)
+        actions = []
+        for line in lines:
+            (action, meta), = line.items()
+            actions.append((action, meta['_id']))
+            if action in ('index', 'create', 'update'):
+                next(lines)
+
+        with ESStubHandler.lock:
+            ESStubHandler.received.append([_id for action, _id in actions])
+            responses = ESStubHandler.scripted_responses
+            status = responses.pop(0) if responses else 200
+            if status != 200:
+                return self.send_json({'error': ERRORS.get(status, 'failed'), 'status': status}, status)
+
+            items = []
+            for action, _id in actions:
+                statuses = ESStubHandler.scripted_items.get(_id)
+                status = statuses.pop(0) if statuses else (200 if action == 'delete' else 201)
+                item = {'_id': _id, 'status': status}
+                if status >= 300:
+                    item['error'] = ERRORS.get(status, 'failed')
+                items.append({action: item})
+
+        self.send_json({
+            'took': 1, 'errors': any('error' in item[action] for item in items for action in item),
+            'items': items
+        })
+
+
+def serve(port_queue, port):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), ESStubHandler)
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+class ESStub(object):
+
+    def __init__(self, port=0):
+        self.port = port
+        self.process = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{0}".format(self.port)
+
+    def start(self):
+        port_queue = multiprocessing.Queue()
+        self.process = multiprocessing.Process(target=serve, args=(port_queue, self.port))
+        self.process.daemon = True
+        self.process.start()
+        self.port = port_queue.get(timeout=10)
+        return self
+
+    def request(self, method, path, data=None):
+        request = urllib.request.Request(
+            self.url + path, method=method,
+            data=json.dumps(data).encode('utf-8') if data is not None else None
+        )
+        with urllib.request.urlopen(request) as response:
+            return json.loads(response.read().decode('utf-8'))
+
+    def script(self, responses=None, items=None):
+        """
+        Script the failures of the next requests, forgetting the ones received.
+
+        :param responses: statuses of the next _bulk requests, 200 to succeed
+        :param items: dict _id -> statuses of the next actions with that _id
+        """
+        self.request('POST', '/_stub', {'responses': responses or [], 'items': items or {}})
+
+    def received(self):
+        """
+        :return: list of the _ids of the actions of each _bulk request
+          received since the script
+        """
+        return self.request('GET', '/_stub')['received']
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+            self.process = None
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Run a stub ElasticSearch node.')
+    parser.add_argument('--port', type=int, default=9200)
+    args = parser.parse_args()
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', args.port), ESStubHandler)
+    print("Stub ElasticSearch listening on http://127.0.0.1:{0}".format(args.port))
+    server.serve_forever()
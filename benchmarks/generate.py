@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+#  -*- coding: utf-8 -*-
+"""
+Generate synthetic Minint archives, with the layout of the ones published on
+http://amministratori.interno.it/, and a small catasto DB the places in the
+archives can be resolved against.
+
+Usage, from the root of the repository:
+
+    python -m benchmarks.generate OUTPUT_DIR [--rows N] [--seed S]
+
+writes ammcom.zip, ammprov.zip, ammreg.zip, comuni_storici.zip,
+province_storici.zip, regioni_storici.zip and catasto.db into OUTPUT_DIR.
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import zipfile
+from utils.codice_fiscale import db
+
+__author__ = 'guglielmo'
+
+
+# institution -> (current file, storici file)
+FILENAMES = {
+    'comune': ('ammcom.txt', 'comuni_storici.txt'),
+    'provincia': ('ammprov.txt', 'province_storici.txt'),
+    'regione': ('ammreg.txt', 'regioni_storici.txt'),
+}
+
+COLUMNS = [
+    'codice_regione', 'denominazione_regione', 'codice_provincia', 'denominazione_provincia',
+    'sigla_provincia', 'codice_comune', 'denominazione_comune', 'popolazione_censita',
+    'cognome', 'nome', 'sesso', 'data_nascita', 'luogo_nascita', 'descrizione_carica',
+    'data_elezione', 'data_entrata_in_carica', 'partito', 'titolo_accademico',
+    'titolo_studio', 'professione',
+]
+
+STORICI_COLUMNS = [
+    'cod_regione', 'desc_regione', 'cod_provincia', 'desc_provincia', 'sigla_provincia',
+    'cod_comune', 'desc_comune', 'popolazione_censita', 'cognome', 'nome', 'sesso',
+    'data_nascita', 'desc_sede_nascita', 'descrizione_carica', 'data_nomina',
+    'data_cessazione', 'desc_partito', 'titolo_di_studio', 'professione',
+]
+
+COGNOMI = [
+    'ROSSI', 'RUSSO', 'FERRARI', 'ESPOSITO', 'BIANCHI', 'ROMANO', 'COLOMBO', 'RICCI',
+    'MARINO', 'GRECO', 'BRUNO', 'GALLO', 'CONTI', "DE LUCA", 'MANCINI', 'COSTA',
+    "D'ANDREA", 'DI NANNI', 'NOÈ', 'BO', 'LOMBARDI', 'MORETTI', 'BARBIERI', 'FONTANA',
+]
+NOMI = [
+    'MARIO', 'GIUSEPPE', 'ANTONIO', 'GIOVANNI', 'LUCA', 'ANDREA', 'FRANCESCO', 'PAOLO',
+    'ANNA', 'MARIA', 'ANNA MARIA', 'GIULIA', 'FRANCESCA', 'CHIARA', 'SARA', 'NICOLÒ',
+]
+CARICHE = [
+    'Sindaco', 'Vicesindaco', 'Assessore', 'Consigliere', 'Consigliere', 'Consigliere',
+    'Consigliere', 'Presidente del consiglio',
+]
+PARTITI = ['LISTA CIVICA', 'PARTITO DEMOCRATICO', 'FORZA ITALIA', 'MOVIMENTO 5 STELLE', '']
+TITOLI = ['LAUREA', 'LICENZA MEDIA SUPERIORE', 'LICENZA MEDIA INFERIORE', '']
+PROFESSIONI = ['AVVOCATO', 'MEDICO', 'INSEGNANTE', 'IMPIEGATO', 'PENSIONATO', '']
+
+
+def write_catasto_db(path, comuni=500, seed=0):
+    """
+    Write a catasto DB with a sample of the comuni, all the stati and province.
+    """
+    rnd = random.Random(seed)
+    source = db.Connessione()
+    rows = {}
+    for table in ('comuni', 'stati', 'province'):
+        source.cur.execute('SELECT * FROM {0};'.format(table))
+        rows[table] = source.cur.fetchall()
+    source.chiudi()
+    rows['comuni'] = rnd.sample(rows['comuni'], min(comuni, len(rows['comuni'])))
+
+    if os.path.exists(path):
+        os.remove(path)
+    con = sqlite3.connect(path)
+    with con:
+        con.execute('CREATE TABLE comuni (codice TEXT, comune TEXT, provincia TEXT)')
+        con.execute('CREATE TABLE stati (codice TEXT, stato TEXT, provincia TEXT)')
+        con.execute('CREATE TABLE province (sigla TEXT)')
+        con.executemany('INSERT INTO comuni VALUES (?, ?, ?)', rows['comuni'])
+        con.executemany('INSERT INTO stati VALUES (?, ?, ?)', rows['stati'])
+        con.executemany('INSERT INTO province VALUES (?)', rows['province'])
+    con.close()
+
+    return [(comune, provincia) for codice, comune, provincia in rows['comuni']], \
+           [stato for codice, stato, provincia in rows['stati']]
+
+
+def random_date(rnd, start_year, end_year):
+    return "{0:02d}/{1:02d}/{2}".format(
+        rnd.randint(1, 28), rnd.randint(1, 12), rnd.randint(start_year, end_year)
+    )
+
+
+def generate_rows(rows, comuni, stati, storici=False, seed=0):
+    """
+    Yield the values of synthetic rows, with the same shape and the same
+    kind of repetitions as the real files. About 1% of the rows are commissari,
+    1% have a birthplace that can't be resolved, 0.5% a wrong birth date.
+    """
+    rnd = random.Random(seed)
+    for i in range(rows):
+        area = rnd.choice(comuni)
+        r = rnd.random()
+        if r < 0.94:
+            luogo = "{0} ({1})".format(*rnd.choice(comuni))
+        elif r < 0.99:
+            luogo = rnd.choice(stati)
+        else:
+            luogo = "LUOGO IGNOTO (XX)"
+        nascita = random_date(rnd, 1930, 1995)
+        if rnd.random() < 0.005:
+            nascita = "31/02/1970"
+        carica = rnd.choice(CARICHE) if rnd.random() > 0.01 else 'Commissario straordinario'
+        area_values = [
+            "{0:02d}".format(i % 20 + 1), 'REGIONE', "{0:03d}".format(i % 110 + 1), 'PROVINCIA',
+            area[1], "{0:04d}".format(i % 8000 + 1), area[0], str(rnd.randint(100, 3000000)),
+        ]
+        person_values = [
+            rnd.choice(COGNOMI), rnd.choice(NOMI), rnd.choice('MF'), nascita,
+        ]
+        if storici:
+            yield area_values + person_values + [
+                luogo.split(' (')[0], carica,
+                random_date(rnd, 1990, 2005), random_date(rnd, 2006, 2014),
+                rnd.choice(PARTITI), rnd.choice(TITOLI), rnd.choice(PROFESSIONI),
+            ]
+        else:
+            yield area_values + person_values + [
+                luogo, carica,
+                random_date(rnd, 2010, 2014), random_date(rnd, 2010, 2014),
+                rnd.choice(PARTITI), '', rnd.choice(TITOLI), rnd.choice(PROFESSIONI),
+            ]
+
+
+def write_archive(path, institution, rows, comuni, stati, storici=False, seed=0):
+    """
+    Write a zipped, latin1 encoded, semicolon separated Minint file,
+    with the 2 lines of notes on top of the current ones.
+    """
+    current_name, storici_name = FILENAMES[institution]
+    if storici:
+        member = storici_name
+        lines = [";".join(STORICI_COLUMNS)]
+    else:
+        member = "amministratori/{0}".format(current_name)
+        lines = ["Dati aggiornati al 01/01/2015", "Fonte: synthetic", ";".join(COLUMNS)]
+
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        with archive.open(member, 'w') as f:
+            f.write(("\r\n".join(lines) + "\r\n").encode('latin1'))
+            for values in generate_rows(rows, comuni, stati, storici=storici, seed=seed):
+                f.write((";".join(values) + "\r\n").encode('latin1'))
+    return path
+
+
+def generate(output_dir, rows, seed=0):
+    """
+    :return: dict with the paths of the catasto DB and of the archives
+    """
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    paths = {'catasto': os.path.join(output_dir, 'catasto.db')}
+    comuni, stati = write_catasto_db(paths['catasto'], seed=seed)
+    for institution, (current_name, storici_name) in FILENAMES.items():
+        for storici, name in ((False, current_name), (True, storici_name)):
+            path = os.path.join(output_dir, name.replace('.txt', '.zip'))
+            paths[os.path.basename(path)] = write_archive(
+                path, institution, rows, comuni, stati, storici, seed
+            )
+    return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate synthetic Minint archives.')
+    parser.add_argument('output_dir')
+    parser.add_argument('--rows', type=int, default=10000, help='Rows per archive.')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    for name, path in sorted(generate(args.output_dir, args.rows, args.seed).items()):
+        print("{0:<24} {1}".format(name, path))
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+#  -*- coding: utf-8 -*-
+"""
+Time the import of the modules of the script, with python -X importtime,
+and check it stays lazy: no heavy dependency imported, no file written.
+
+Usage, from the root of the repository:
+
+    python -m benchmarks.importtime [--modules scrapers,storers,scrape2es]
+                                    [--repeat 5] [--budget_ms 120] [--top 10]
+
+The minimum over the repetitions is compared with the budget; the exit
+status is 1 if the budget is exceeded, a forbidden module gets imported
+or a file is created in the working directory.
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+__author__ = 'guglielmo'
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# imported only when there's something to download, send or compute
+FORBIDDEN = ['requests', 'slugify', 'numpy', 'multiprocessing', 'tortilla']
+
+
+def importtime(modules, cwd):
+    """
+    Import the modules in a fresh interpreter, run in cwd.
+
+    :return: dict module name -> cumulative import time, in microseconds
+    :raise subprocess.CalledProcessError: if the import fails
+    """
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import {0}'.format(', '.join(modules))],
+        cwd=cwd, env=env, stderr=subprocess.PIPE, universal_newlines=True, check=True
+    )
+
+    times = {}
+    for line in process.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the import of the modules of the script.')
+    parser.add_argument('--modules', type=str, default='scrapers,storers,scrape2es',
+        help='Comma separated list of the modules to import.')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--budget_ms', type=float, default=120.0,
+        help='Maximum time to import all the modules, in milliseconds.')
+    parser.add_argument('--top', type=int, default=10, help='Number of the slowest modules listed.')
+    args = parser.parse_args()
+
+    modules = args.modules.split(',')
+    cwd = tempfile.mkdtemp(prefix='scrapeit-importtime-')
+
+    # the best of the repetitions, module by module
+    times = {}
+    for _ in range(args.repeat):
+        for name, cumulative in importtime(modules, cwd).items():
+            times[name] = min(times.get(name, cumulative), cumulative)
+
+    total_ms = sum(times.get(name, 0) for name in modules) / 1000.0
+    print("import {0}: {1:.1f} ms (budget {2:.1f} ms)".format(', '.join(modules), total_ms, args.budget_ms))
+    for name, cumulative in sorted(times.items(), key=lambda item: -item[1])[:args.top]:
+        print("    {0:<40} {1:>8.1f} ms".format(name, cumulative / 1000.0))
+
+    failures = []
+    if total_ms > args.budget_ms:
+        failures.append("import takes {0:.1f} ms, over the budget".format(total_ms))
+    for name in FORBIDDEN:
+        if name in times:
+            failures.append("{0} imported".format(name))
+    for name in os.listdir(cwd):
+        failures.append("{0} created on import".format(name))
+    shutil.rmtree(cwd)
+
+    for failure in failures:
+        print("FAILED {0}".format(failure))
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
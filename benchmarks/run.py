@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+#  -*- coding: utf-8 -*-
+"""
+Time each stage of an import, on synthetic Minint archives:
+unzip and decode, csv parsing, codice fiscale computation, unique_id,
+bulk json serialization and sending to a stub ElasticSearch node.
+
+Usage, from the root of the repository:
+
+    python -m benchmarks.run [--rows N] [--archives ammcom.zip,...]
+                             [--gzip] [--json_encoder orjson|ujson|json] [--es_nodes N]
+                             [--output results.json]
+                             [--baseline previous.json] [--tolerance 0.2]
+
+Results are written as json. With a baseline, the rows/s of each stage
+are compared with it and the exit status is 1 if any stage got slower
+than the tolerance allows.
+"""
+
+import argparse
+import collections
+import csv
+import datetime
+import itertools
+import json
+import platform
+import sys
+import tempfile
+import time
+
+from benchmarks import generate
+from benchmarks.es_stub import ESStub
+import scrapers
+from scrapers import DataScraperException, MinintDataScraper, MinintStoriciDataScraper
+from storers import ESDataStorer
+from utils.codice_fiscale import db
+
+__author__ = 'guglielmo'
+
+
+STAGES = ['unzip_decode', 'csv_parse', 'codice_fiscale', 'unique_id', 'bulk_serialize', 'es_send']
+
+
+def bench_archive(path, scraper_class, storer, batch_size):
+    """
+    Run an archive through all the stages, one batch at a time,
+    timing each stage separately.
+
+    :return: dict with rows, errors and the timings of the stages
+    """
+    timings = collections.OrderedDict((stage, 0.0) for stage in STAGES)
+    rows_count = errors = 0
+
+    dsc = scraper_class(path, 'warning')
+    dsc.archive_file, dsc.archive_hash = open(path, 'rb'), None
+
+    start = time.perf_counter()
+    file, archive_txt = dsc.open_archive()
+    fieldnames = next(csv.reader([archive_txt.readline()], delimiter=";"))
+    timings['unzip_decode'] += time.perf_counter() - start
+    institution = dsc.get_institution(file)
+
+    while True:
+        start = time.perf_counter()
+        lines = list(itertools.islice(archive_txt, batch_size))
+        timings['unzip_decode'] += time.perf_counter() - start
+        if not lines:
+            break
+
+        start = time.perf_counter()
+        reader = dsc.reader_class(lines, delimiter=";", fieldnames=fieldnames, institution=institution)
+        rows = list(reader.raw_rows())
+        timings['csv_parse'] += time.perf_counter() - start
+        rows_count += len(rows)
+
+        start = time.perf_counter()
+        enriched = []
+        for row in rows:
+            try:
+                row['codice_fiscale'] = reader.compute_codice_fiscale(row)
+            except DataScraperException:
+                errors += 1
+                continue
+            enriched.append(row)
+        timings['codice_fiscale'] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        for row in enriched:
+            row['istituzione'] = institution
+            row['unique_id'] = reader.get_unique_id(row)
+        timings['unique_id'] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        actions = list(storer.get_bulk_data(enriched))
+        timings['bulk_serialize'] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        storer.send_batch(actions)
+        timings['es_send'] += time.perf_counter() - start
+
+    stages = collections.OrderedDict()
+    for stage, seconds in timings.items():
+        stages[stage] = {
+            'seconds': round(seconds, 6),
+            'rows_per_s': round(rows_count / seconds, 1) if seconds else None,
+        }
+    total = sum(timings.values())
+    return {
+        'rows': rows_count,
+        'errors': errors,
+        'stages': stages,
+        'total': {'seconds': round(total, 6), 'rows_per_s': round(rows_count / total, 1)},
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    :return: list of (archive, stage, baseline rows/s, rows/s) for the regressions
+    """
+    regressions = []
+    for name, result in results['archives'].items():
+        old = baseline['archives'].get(name)
+        if old is None:
+            continue
+        for stage, timing in list(result['stages'].items()) + [('total', result['total'])]:
+            old_timing = old['total'] if stage == 'total' else old['stages'].get(stage)
+            if not old_timing or not old_timing['rows_per_s'] or not timing['rows_per_s']:
+                continue
+            if timing['rows_per_s'] < old_timing['rows_per_s'] * (1 - tolerance):
+                regressions.append((name, stage, old_timing['rows_per_s'], timing['rows_per_s']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the stages of an import.')
+    parser.add_argument('--rows', type=int, default=10000, help='Rows per archive, 10k to 1M.')
+    parser.add_argument('--archives', type=str,
+        default='ammcom.zip,ammprov.zip,ammreg.zip,comuni_storici.zip',
+        help='Comma separated list of the archives to time.')
+    parser.add_argument('--batch_size', type=int, default=1000)
+    parser.add_argument('--data_dir', type=str, default=None,
+        help='Where to generate the archives, a temporary directory by default.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--gzip', action='store_true', help='Gzip compress the bulk bodies.')
+    parser.add_argument('--es_nodes', type=int, default=1,
+        help='Number of stub ElasticSearch nodes the requests are spread over.')
+    parser.add_argument('--json_encoder', type=str, default=None,
+        help='orjson, ujson or json; the fastest one installed by default.')
+    parser.add_argument('--output', type=str, default=None, help='Write results to this json file.')
+    parser.add_argument('--baseline', type=str, default=None, help='Compare with a previous json results file.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+        help='Fraction of rows/s a stage may lose with respect to the baseline.')
+    args = parser.parse_args()
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='scrapeit-bench-')
+    paths = generate.generate(data_dir, args.rows, args.seed)
+
+    # resolve birthplaces against the fixture catasto DB
+    scrapers.resolver = scrapers.BirthplaceResolver(db.IndiceCodici(paths['catasto']))
+
+    stubs = [ESStub().start() for _ in range(args.es_nodes)]
+    try:
+        storer = ESDataStorer(
+            es_url=[stub.url for stub in stubs], es_index='politici', es_doctype='incarico',
+            es_batchsize=args.batch_size, es_gzip=args.gzip,
+            json_encoder=args.json_encoder, log_level='warning'
+        )
+        results = {
+            'timestamp': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'rows': args.rows,
+            'batch_size': args.batch_size,
+            'gzip': args.gzip,
+            'es_nodes': args.es_nodes,
+            'json_encoder': storer.json_encoder,
+            'archives': collections.OrderedDict(),
+        }
+        for name in args.archives.split(','):
+            scraper_class = MinintStoriciDataScraper if '_storici' in name else MinintDataScraper
+            results['archives'][name] = bench_archive(
+                paths[name], scraper_class, storer, args.batch_size
+            )
+    finally:
+        for stub in stubs:
+            stub.stop()
+
+    for name, result in results['archives'].items():
+        print("{0} ({1} rows, {2} errors)".format(name, result['rows'], result['errors']))
+        for stage, timing in list(result['stages'].items()) + [('total', result['total'])]:
+            print("    {0:<16} {1:>10.3f} s {2:>14,.0f} rows/s".format(
+                stage, timing['seconds'], timing['rows_per_s'] or 0))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for name, stage, old_rate, rate in regressions:
+            print("REGRESSION {0} {1}: {2:,.0f} -> {3:,.0f} rows/s".format(name, stage, old_rate, rate))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,35 +1,141 @@
 #!/usr/bin/env python
 #  -*- coding: utf-8 -*-
 
+import collections
 import csv
-from datetime import datetime
+import functools
+import hashlib
 import io
-import json
+import itertools
 import logging
-import logging.config
 import re
-import requests
+import tempfile
+import threading
 import zipfile
-from slugify import slugify
-from utils import DictReaderInsensitive, DictInsensitive
+from utils import FastDictReaderInsensitive
+from utils.cache import ArchiveCache
+from utils.dates import parse_date, compact_date
+from utils.metrics import Metrics, null_metrics
 from utils.codice_fiscale import db
 from utils.codice_fiscale.codicefiscale import codice_fiscale, codice_cognome, codice_nome
 
 __author__ = 'guglielmo'
 
-# define connection to sqlite DB with places->catasto codes
-con = db.Connessione()
-
 # pre-compile some regular expressions used within the loops
 prov_com_re = re.compile(r'(?P<city>[\w \']+)\((?P<prov>[\w \']+)\)')
 state_re = re.compile(r'(?P<state>[\w \']+)')
 
-
-logging.config.dictConfig(json.load(open('logging.conf.json')))
-
 class DataScraperException(Exception):
     pass
 
+class BirthplaceResolver(object):
+    """
+    Resolve the luogo_nascita strings of the Minint files into catasto codes,
+    looking them up in an in-memory index of the codes.
+
+    The same places repeat over and over, so resolutions, failures included,
+    are memoized in a bounded LRU cache, keyed by the raw luogo_nascita.
+
+    Unless given, the index is loaded from the sqlite DB at the first lookup.
+    """
+
+    def __init__(self, index=None, maxsize=16384):
+        self._index = index
+        self.lock = threading.Lock()
+        self.resolve_cached = functools.lru_cache(maxsize=maxsize)(self.lookup)
+
+    @property
+    def index(self):
+        if self._index is None:
+            with self.lock:
+                if self._index is None:
+                    self._index = db.IndiceCodici()
+        return self._index
+
+    def lookup(self, luogo_nascita):
+        """
+        :return: tuple (catasto code, None) or (None, error message)
+        """
+        birth_place = {
+            'state': 'ITALIA',
+            'prov': None,
+            'city': None
+        }
+        m = prov_com_re.match(luogo_nascita)
+        if m is None:
+            m = state_re.match(luogo_nascita)
+            if m is None:
+                return None, "Impossibile parsare luogo nascita:{0}:.Skipping.".format(luogo_nascita)
+            birth_place['state'] = m.groupdict()['state']
+        else:
+            birth_place.update({
+                'prov': m.groupdict()['prov'].strip().upper(),
+                'city': m.groupdict()['city'].strip().upper()
+            })
+
+        try:
+            return self.index.codici_geografici(
+                birth_place['state'], birth_place['prov'], birth_place['city']
+            ), None
+        except db.DBNoDataError:
+            return None, "Impossibile determinare CF:{0}:.Skipping.".format(luogo_nascita)
+        except Exception:
+            return None, "Impossibile determinare CF.Skipping."
+
+    def resolve(self, luogo_nascita):
+        code, error = self.resolve_cached(luogo_nascita)
+        if error is not None:
+            raise DataScraperException(error)
+        return code
+
+    def stats(self):
+        info = self.resolve_cached.cache_info()
+        return {
+            'hits': info.hits,
+            'misses': info.misses,
+            'size': info.currsize,
+            'maxsize': info.maxsize,
+        }
+
+# places->catasto codes, loaded once from the sqlite DB, when first needed
+resolver = BirthplaceResolver()
+
+class UniqueIdBuilder(object):
+    """
+    Build the same ids as slugify("-".join(parts)), slugging each part
+    on its own and joining the slugs with dashes.
+
+    Apart from the first one (the codice fiscale), parts repeat a lot
+    (carica, istituzione, localita, dates), so their slugs are memoized.
+    """
+
+    def __init__(self, maxsize=65536):
+        self.maxsize = maxsize
+        self.slugify = None
+        self.slugify_cached = None
+
+    def load(self):
+        # slugify is slow to import, it's done when the first id is built
+        from slugify import slugify
+        self.slugify_cached = functools.lru_cache(maxsize=self.maxsize)(slugify)
+        self.slugify = slugify
+
+    def build(self, first, *parts):
+        if self.slugify is None:
+            self.load()
+
+        # a proper codice fiscale is its own slug, in lower case
+        if first.isalnum() and first.isascii():
+            slugs = [first.lower()]
+        else:
+            slugs = [self.slugify(first)]
+        slugs.extend(self.slugify_cached(part) for part in parts)
+
+        # empty slugs would leave a double dash, that slugify collapses
+        return "-".join(slug for slug in slugs if slug)
+
+unique_ids = UniqueIdBuilder()
+
 class DataScraper(object):
     """
     Base DataScraper class from which each class extends.
@@ -51,46 +157,29 @@ class DataScraper(object):
     def get_iterator(self):
         raise Exception("not implemented")
 
-class MinintCSVDictReader(DictReaderInsensitive):
+class MinintCSVDictReader(FastDictReaderInsensitive):
 
-    def __init__(self, f, institution=None, **kwargs):
-        DictReaderInsensitive.__init__(self, f, **kwargs)
+    def __init__(self, f, institution=None, metrics=null_metrics, **kwargs):
+        FastDictReaderInsensitive.__init__(self, f, **kwargs)
         self.institution = institution
+        self.metrics = metrics
 
     def get_codice_fiscale(self, nome, cognome, data_nascita, luogo_nascita, sesso, **kwargs):
         first_name = nome
         last_name = cognome
 
         try:
-            birth_date = datetime.strptime(data_nascita, "%d/%m/%Y")
+            birth_date = parse_date(data_nascita)
         except ValueError as e:
             raise DataScraperException("Impossibile parsare data nascita:{0}:.Skipping.".format(data_nascita))
 
-        birth_place = {
-            'state': 'ITALIA',
-            'prov': None,
-            'city': None
-        }
-        m = prov_com_re.match(luogo_nascita)
-        if m is None:
-            m = state_re.match(luogo_nascita)
-            if m is None:
-                raise DataScraperException("Impossibile parsare luogo nascita:{0}:.Skipping.".format(luogo_nascita))
-            birth_place['state'] = m.groupdict()['state']
-        else:
-            birth_place.update({
-                'prov': m.groupdict()['prov'].strip().upper(),
-                'city': m.groupdict()['city'].strip().upper()
-            })
+        birth_place_code = resolver.resolve(luogo_nascita)
 
         try:
             return codice_fiscale(
-                last_name, first_name, birth_date, sesso,
-                birth_place['state'], birth_place['prov'], birth_place['city'],
-                con.codici_geografici
+                last_name, first_name, birth_date, sesso, None, None, None,
+                lambda *args: birth_place_code
             )
-        except db.DBNoDataError:
-            raise DataScraperException("Impossibile determinare CF:{0}:.Skipping.".format(luogo_nascita))
         except Exception:
             raise DataScraperException("Impossibile determinare CF.Skipping.")
 
@@ -101,41 +190,68 @@ class MinintCSVDictReader(DictReaderInsensitive):
         key = "denominazione_{0}".format(self.institution)
         localita = row[key]
 
-        start_date = datetime.strptime(row['data_entrata_in_carica'], "%d/%m/%Y").strftime("%Y%m%d")
-
-        unique_id = slugify(
-            "-".join([
-                row['codice_fiscale'],
-                row['descrizione_carica'],
-                istituzione,
-                localita,
-                start_date,
-                'in carica'
-            ])
+        start_date = compact_date(row['data_entrata_in_carica'])
+
+        unique_id = unique_ids.build(
+            row['codice_fiscale'],
+            row['descrizione_carica'],
+            istituzione,
+            localita,
+            start_date,
+            'in carica'
         )
 
         return unique_id
 
 
-    def __next__(self):
-        row = DictReaderInsensitive.__next__(self)
+    def raw_rows(self):
+        """
+        Iterate over the parsed rows, without enriching them.
+        """
+        while True:
+            try:
+                yield FastDictReaderInsensitive.__next__(self)
+            except StopIteration:
+                return
+
+
+    def compute_codice_fiscale(self, row):
+        """
+        The codice fiscale of a parsed row, or its placeholder for commissari.
+        :raise DataScraperException: if it can't be computed
+        """
         carica = row['descrizione_carica'].lower()
         if 'commissario' in carica or 'commissione' in carica:
-            row['codice_fiscale'] = "{0}{1}---------C".format(
+            return "{0}{1}---------C".format(
                 codice_cognome(row['cognome']),
                 codice_nome(row['nome'])
             )
-        else:
-            try:
-                row['codice_fiscale'] = self.get_codice_fiscale(**row)
-            except DataScraperException as e:
-                return  (e, row)
+        return self.get_codice_fiscale(**row)
 
-        row['istituzione'] = self.institution
-        row['unique_id'] = self.get_unique_id(row)
+
+    def enrich(self, row):
+        """
+        Inject codice fiscale, istituzione and unique_id into a parsed row.
+        :return: the row, or a tuple (exception, row) if it can't be enriched
+        """
+        try:
+            with self.metrics.stage('codice_fiscale', cpu=False):
+                row['codice_fiscale'] = self.compute_codice_fiscale(row)
+        except DataScraperException as e:
+            return  (e, row)
+
+        with self.metrics.stage('unique_id', cpu=False):
+            row['istituzione'] = self.institution
+            row['unique_id'] = self.get_unique_id(row)
 
         return row
 
+
+    def __next__(self):
+        with self.metrics.stage('csv_parse', cpu=False):
+            row = FastDictReaderInsensitive.__next__(self)
+        return self.enrich(row)
+
 class MinintStoriciCSVDictReader(MinintCSVDictReader):
 
     def get_unique_id(self, row):
@@ -144,116 +260,275 @@ class MinintStoriciCSVDictReader(MinintCSVDictReader):
         key = "desc_{0}".format(self.institution)
         localita = row[key]
 
-        start_date = datetime.strptime(row['data_nomina'], "%d/%m/%Y").strftime("%Y%m%d")
-        end_date = datetime.strptime(row['data_cessazione'], "%d/%m/%Y").strftime("%Y%m%d")
-
-        unique_id = slugify(
-            "-".join([
-                row['codice_fiscale'],
-                row['descrizione_carica'],
-                istituzione,
-                localita,
-                start_date,
-                end_date
-            ])
+        start_date = compact_date(row['data_nomina'])
+        end_date = compact_date(row['data_cessazione'])
+
+        unique_id = unique_ids.build(
+            row['codice_fiscale'],
+            row['descrizione_carica'],
+            istituzione,
+            localita,
+            start_date,
+            end_date
         )
 
         return unique_id
 
-    def __next__(self):
-        row = DictReaderInsensitive.__next__(self)
-
+    def compute_codice_fiscale(self, row):
         if 'commissario' in row['descrizione_carica'].lower():
-            row['codice_fiscale'] = "{cognome} {nome}".format(**row)
-        else:
-            try:
-                row['codice_fiscale'] = "{cognome} {nome} {data_nascita} {desc_sede_nascita} {sesso}".format(**row)
-            except DataScraperException as e:
-                return  (e, row)
+            return "{cognome} {nome}".format(**row)
+        return "{cognome} {nome} {data_nascita} {desc_sede_nascita} {sesso}".format(**row)
 
-        row['istituzione'] = self.institution
-        row['unique_id'] = self.get_unique_id(row)
 
-        return row
+def parse_chunk(reader_class, fieldnames, lines):
+    reader = reader_class(lines, delimiter=";", fieldnames=fieldnames)
+    return list(reader.raw_rows())
+
+
+def enrich_chunk(reader_class, institution, rows):
+    reader = reader_class([], institution=institution)
+    return [reader.enrich(row) for row in rows]
+
+
+class ParallelReader(object):
+    """
+    Iterate over the rows of a Minint reader, having them enriched
+    by a pool of worker processes.
+
+    Raw rows are parsed in the main process and sent to the workers
+    in chunks; enriched rows are yielded in their original order.
+
+    Enrichment can't be timed in the workers: the time spent waiting
+    for their results is measured instead, as the enrich_wait stage.
+
+    The pool may be shared by many readers, passing it as executor.
+    """
+
+    def __init__(self, reader, workers, chunk_size=1000, executor=None):
+        self.reader = reader
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.executor = executor
+        self.metrics = reader.metrics
+
+    def chunks(self):
+        raw_rows = self.reader.raw_rows()
+        while True:
+            with self.metrics.stage('csv_parse'):
+                chunk = list(itertools.islice(raw_rows, self.chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+    def __iter__(self):
+        if self.executor is not None:
+            for row in self.enriched(self.executor):
+                yield row
+            return
+
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(self.workers) as executor:
+            for row in self.enriched(executor):
+                yield row
+
+    def enriched(self, executor):
+        reader_class = type(self.reader)
+        institution = self.reader.institution
+        # keep a couple of chunks per worker in flight, no more
+        pending = collections.deque()
+        for chunk in self.chunks():
+            pending.append(executor.submit(enrich_chunk, reader_class, institution, chunk))
+            if len(pending) > 2 * self.workers:
+                for row in self.wait(pending.popleft()):
+                    yield row
+        while pending:
+            for row in self.wait(pending.popleft()):
+                yield row
+
+    def wait(self, future):
+        with self.metrics.stage('enrich_wait'):
+            return future.result()
 
 
 class MinintDataScraper(DataScraper):
 
-    def __init__(self, url, log_level):
+    # the csv reader class used to parse and enrich the archive's content
+    reader_class = MinintCSVDictReader
+
+    # number of lines of notes preceding the csv header
+    skip_lines = 2
+
+    # size of the chunks the archive is downloaded with
+    chunk_size = 64 * 1024
+
+    def __init__(self, url, log_level, cache_dir=None, workers=1, executor=None, metrics=None):
         DataScraper.__init__(self)
         self.url = url
         self.log_level = log_level
+        self.workers = workers
+        # a process pool shared with other scrapers, instead of one of its own
+        self.executor = executor
+        self.cache = ArchiveCache(cache_dir) if cache_dir else None
 
+        # shared with the reader and, through the command, with the storer
+        self.metrics = metrics if metrics is not None else Metrics()
 
-    def scrape(self):
+        # the downloaded archive and the sha256 of its content
+        self.archive_file = None
+        self.archive_hash = None
+
+
+    def scrape(self, offset=0):
+        """
+        :param offset: number of rows to skip, when resuming an import
+        """
         self.logger.setLevel(getattr(logging, self.log_level.upper(), logging.WARNING))
 
         self.logger.info("Start")
         self.logger.debug("minint_url: {0}".format(self.url))
 
         # retrieve bulk_data from minint_url
-        return self.get_iterator()
+        return self.get_iterator(offset)
 
 
-    def get_iterator(self):
+    def download(self):
         """
-        Read the zip file from the site, extract its content and return a csv.DictReader to it
-        :return: csv.DictReader
+        Spool the zip file from the url into a file on disk, one chunk
+        at a time, so that the archive is never held in memory.
+
+        When a cache is used, the request is conditional and the cached
+        archive is returned if the server reports it as not modified.
+
+        :return: tuple (file positioned at its beginning, content hash)
+        """
+        import requests
+
+        with self.metrics.stage('download'):
+            headers = self.cache.conditional_headers(self.url) if self.cache else {}
+            r = requests.get(self.url, stream=True, headers=headers)
+            if r.status_code == 304:
+                self.logger.info("Archive not modified since last download, using cached copy")
+                self.metrics.incr('archive_not_modified')
+                return self.cache.open(self.url)
+            r.raise_for_status()
+
+            if self.cache:
+                archive_file, content_hash = self.cache.store(self.url, r, self.chunk_size)
+            else:
+                content_hash = hashlib.sha256()
+                archive_file = tempfile.TemporaryFile()
+                for chunk in r.iter_content(chunk_size=self.chunk_size):
+                    content_hash.update(chunk)
+                    archive_file.write(chunk)
+                archive_file.seek(0)
+                content_hash = content_hash.hexdigest()
+
+            # the spooled file's size is what went over the wire, once decoded
+            archive_file.seek(0, 2)
+            self.metrics.incr('bytes_downloaded', archive_file.tell())
+            archive_file.seek(0)
+
+        return archive_file, content_hash
+
+
+    def fetch(self):
         """
-        # request zip file from url
-        r = requests.get(self.url)
+        Download the archive, once.
+        :return: the archive file
+        """
+        if self.archive_file is None:
+            self.archive_file, self.archive_hash = self.download()
+            self.logger.debug("archive sha256: {0}".format(self.archive_hash))
+        return self.archive_file
+
+
+    def is_unchanged(self, target):
+        """
+        Tell whether the archive is byte-identical to the last one
+        completely ingested into target. Always False without a cache.
+        """
+        if self.cache is None:
+            return False
+        self.fetch()
+        return self.cache.is_ingested(self.url, self.archive_hash, target)
+
+
+    def mark_ingested(self, target):
+        if self.cache is not None:
+            self.cache.mark_ingested(self.url, self.archive_hash, target)
+
+
+    def open_archive(self):
+        """
+        Open the first file contained in the downloaded zip archive
+        as a text stream, decompressed and decoded on the fly.
+        The lines of notes at the top of the file are skipped.
 
-        # read content from url and create a ZipFile out of it's content,
-        archive = zipfile.ZipFile(io.BytesIO(r.content), 'r')
+        :return: tuple (filename, text stream)
+        """
+        archive = zipfile.ZipFile(self.fetch(), 'r')
 
         # extract filename
-        file = archive.infolist()[0].filename
+        info = archive.infolist()[0]
+        file = info.filename
+        self.metrics.incr('bytes_compressed', info.compress_size)
+        self.metrics.incr('bytes_decompressed', info.file_size)
 
-        # uncompress zipped file and remove the first 2 lines (they are notes)
-        archive_txt = "\n".join(archive.read(file).decode('latin1').split("\r\n")[2:])
+        # newline='' leaves the \r\n line endings to the csv reader
+        archive_txt = io.TextIOWrapper(archive.open(file), encoding='latin1', newline='')
+        for _ in range(self.skip_lines):
+            archive_txt.readline()
 
-        # create an extended csv.DictReader
-        # injecting codice fiscale and unique_id computation
+        return file, archive_txt
+
+
+    def get_institution(self, file):
         dummy, filename = file.split("/")
-        institution = {
+        return {
             'ammreg.txt': 'regione',
             'ammprov.txt': 'provincia',
             'ammcom.txt': 'comune'
         }[filename]
-        archive_reader = MinintCSVDictReader(io.StringIO(archive_txt), delimiter=";", institution=institution)
-
-        return archive_reader
-
 
-class MinintStoriciDataScraper(MinintDataScraper):
 
-    def get_iterator(self):
+    def get_iterator(self, offset=0):
         """
-        Read the zip file from the site, extract its content and return a csv.DictReader to it
+        Stream the zip file from the site and return a csv.DictReader to its content.
+        Rows are read lazily, while the archive is decompressed.
+        The first offset rows are skipped, without being enriched.
         :return: csv.DictReader
         """
-        # request zip file from url
-        r = requests.get(self.url)
+        file, archive_txt = self.open_archive()
 
-        # read content from url and create a ZipFile out of it's content,
-        archive = zipfile.ZipFile(io.BytesIO(r.content), 'r')
+        # create an extended csv.DictReader
+        # injecting codice fiscale and unique_id computation
+        archive_reader = self.reader_class(
+            archive_txt, delimiter=";", institution=self.get_institution(file),
+            metrics=self.metrics
+        )
 
-        # extract filename
-        file = archive.infolist()[0].filename
+        if offset:
+            with self.metrics.stage('skip'):
+                skipped = archive_reader.skip(offset)
+            self.logger.info("Resuming: {0} rows skipped".format(skipped))
 
-        # uncompress zipped file
-        archive_txt = "\n".join(archive.read(file).decode('latin1').split("\r\n"))
+        # enrich rows in a pool of processes
+        if self.workers > 1:
+            return ParallelReader(archive_reader, self.workers, executor=self.executor)
 
-        # create an extended csv.DictReader
-        # injecting codice fiscale and unique_id computation
+        return archive_reader
+
+
+class MinintStoriciDataScraper(MinintDataScraper):
+
+    reader_class = MinintStoriciCSVDictReader
+
+    skip_lines = 0
+
+    def get_institution(self, file):
         institution_context = file[:-12]
-        institution = {
+        return {
             'regioni':  'regione',
             'province': 'provincia',
             'comuni':   'comune'
         }[institution_context]
-        archive_reader = MinintStoriciCSVDictReader(
-            io.StringIO(archive_txt), delimiter=";", institution=institution
-        )
-
-        return archive_reader
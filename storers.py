@@ -1,28 +1,29 @@
 #!/usr/bin/env python
 #  -*- coding: utf-8 -*-
 
+import collections
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import glob
+import gzip
 import json
 import logging
-import logging.config
-import itertools
-from requests.auth import _basic_auth_str
-from requests.exceptions import HTTPError
-import tortilla
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+import zlib
 from scrapers import DataScraperException
+from utils.delta import DeltaState, DeletedRow
+from utils.encoders import get_encoder
+from utils.metrics import Metrics
+from utils.pipeline import merge
 
 __author__ = 'guglielmo'
 
 
-
-logging.config.dictConfig(json.load(open('logging.conf.json')))
-
-
-def grouper(iterable, n, fillvalue=None):
-    args = [iter(iterable)] * n
-    return itertools.zip_longest(*args, fillvalue=fillvalue)
-
-
 class DataStorerException(Exception):
     pass
 
@@ -46,87 +47,954 @@ class DataStorer(object):
 
 
 
-class ESDataStorer(DataStorer):
+class BulkDataStorer(DataStorer):
+    """
+    Base class of the storers turning rows into the actions
+    of ElasticSearch _bulk requests.
 
-    def __init__(self, es_url,
-                 es_index, es_doctype,
-                 es_batchsize=0, es_delete=False,
+    Without an index and a doctype, the actions go to the ones
+    of the url they are posted to: /<index>/<doctype>/_bulk.
+    """
+
+    def __init__(self, es_index=None, es_doctype=None,
+                 json_encoder=None,
+                 metrics=None,
                  log_level='info'
     ):
         DataStorer.__init__(self)
+        self.metrics = metrics if metrics is not None else Metrics()
 
         self.log_level = log_level
-        self.es_url = es_url
+        self.logger.setLevel(getattr(logging, self.log_level.upper(), logging.WARNING))
+
         self.es_index = es_index
         self.es_doctype = es_doctype
-        self.es_batchsize = es_batchsize
-        self.es_delete = es_delete
 
-        self.logger.setLevel(getattr(logging, self.log_level.upper(), logging.WARNING))
+        # documents are serialized into bytes, by the fastest encoder available
+        self.json_encoder, self.dumps = get_encoder(json_encoder)
+
+        # action lines only differ by their _id, what precedes it is encoded once
+        meta = collections.OrderedDict()
+        if es_index:
+            meta['_index'] = es_index
+        if es_doctype:
+            meta['_type'] = es_doctype
+        meta['_id'] = ''
+        self.index_prefix, self.delete_prefix = (
+            self.dumps({op: meta})[:-len(b'""}}')] for op in ('index', 'delete')
+        )
 
-        self.est = tortilla.wrap(self.es_url)
+        # position in the source: the number of rows pulled from it,
+        # and the unique_id of the last one
+        self.offset = 0
+        self.last_unique_id = None
 
-        self.es_setup()
 
+    def get_bulk_data(self, iterator):
+        """
+        Generate the actions of the _bulk requests, out of the rows.
+        Each action is serialized once, as the lines to send:
+        action and source for an indexed row, action only for a deleted one.
 
+        :param iterator: the rows, error tuples and DeletedRows to process
+        :return: generator of bytes
+        """
+        dumps = self.dumps
+        for row in iterator:
+            self.offset += 1
+            if type(row) == tuple:
+                self.logger.error(row[0])
+                self.logger.error(",".join(row[1].values()))
+                self.metrics.error(row[0])
+                self.metrics.incr('rows_skipped')
+                continue
 
+            if isinstance(row, DeletedRow):
+                self.logger.debug("Deleting:{0}".format(row.unique_id))
+                self.metrics.incr('rows_deleted')
+                yield self.delete_prefix + dumps(row.unique_id) + b"}}\n"
+                continue
 
-    def get_bulk_data(self, iterator):
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug("Processing:{0}".format(",".join(row.values())))
+            self.metrics.incr('rows')
+
+            with self.metrics.stage('bulk_serialize', cpu=False):
+                self.last_unique_id = unique_id = row.pop('unique_id')
+                action = self.index_prefix + dumps(unique_id) + b"}}\n" + dumps(row) + b"\n"
+            yield action
+
+
+
+class BulkFileDataStorer(BulkDataStorer):
+    """
+    Write the actions of the _bulk requests into NDJSON files,
+    ready to be posted to /<index>/<doctype>/_bulk, or loaded with
+    ESDataStorer.load: loading them again needs no parsing,
+    no codici fiscali, just I/O.
+
+    Files are named <name>-00000.ndjson, <name>-00001.ndjson, ... and a new one
+    is started as soon as the current one holds shard_rows actions, or
+    shard_bytes bytes before compression, so that they can be loaded in parallel.
+    A file is only given its name once complete.
+    """
+
+    # as for the bodies of the bulk requests
+    gzip_level = 3
+
+    def __init__(self, bulk_dir, name='bulk',
+                 shard_bytes=100 * 1024 * 1024, shard_rows=0,
+                 bulk_gzip=False, buffer_size=1024 * 1024,
+                 json_encoder=None,
+                 metrics=None,
+                 log_level='info'
+    ):
+        BulkDataStorer.__init__(
+            self, json_encoder=json_encoder, metrics=metrics, log_level=log_level
+        )
+        self.bulk_dir = bulk_dir
+        self.name = name
+        self.shard_bytes = shard_bytes
+        self.shard_rows = shard_rows
+        self.bulk_gzip = bulk_gzip
+        self.buffer_size = buffer_size
+
+        # paths of the files completed
+        self.paths = []
+
+        self.shard = None
+        self.compressor = None
+        self.buffer = []
+        self.buffered = 0
+        self.shard_actions = 0
+        self.shard_size = 0
+
+
+    def shard_path(self, n):
+        return os.path.join(
+            self.bulk_dir, "{0}-{1:05d}.ndjson{2}".format(self.name, n, '.gz' if self.bulk_gzip else '')
+        )
+
+
+    def store(self, iterator):
+        """
+        :return: the paths of the files written
         """
+        os.makedirs(self.bulk_dir, exist_ok=True)
 
-        :param file:
-        :param minint_url:
-        :return:
+        # the files of a previous run are replaced
+        for path in glob.glob(os.path.join(self.bulk_dir, "{0}-*.ndjson*".format(glob.escape(self.name)))):
+            os.remove(path)
+
+        self.logger.info("Writing bulk files into {0}".format(self.bulk_dir))
+        try:
+            for action in self.get_bulk_data(iterator):
+                if self.shard is None:
+                    self.open_shard()
+                self.buffer.append(action)
+                self.buffered += len(action)
+                self.shard_actions += 1
+                self.shard_size += len(action)
+                if self.buffered >= self.buffer_size:
+                    self.flush()
+                if (self.shard_rows and self.shard_actions >= self.shard_rows) or \
+                        (self.shard_bytes and self.shard_size >= self.shard_bytes):
+                    self.close_shard()
+        except Exception:
+            # an incomplete file is left with its temporary name
+            if self.shard is not None:
+                self.shard.close()
+            raise
+
+        if self.shard is not None:
+            self.close_shard()
+
+        self.logger.info("{0} bulk files written into {1}".format(len(self.paths), self.bulk_dir))
+        return self.paths
+
+
+    def open_shard(self):
+        self.shard = open(self.shard_path(len(self.paths)) + '.part', 'wb')
+        if self.bulk_gzip:
+            self.compressor = zlib.compressobj(self.gzip_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self.shard_actions = 0
+        self.shard_size = 0
+
+
+    def flush(self):
+        """
+        Write the buffered actions, in a single call.
+        """
+        data = b"".join(self.buffer)
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        with self.metrics.stage('bulk_write'):
+            self.shard.write(data)
+        self.metrics.incr('bytes_serialized', self.buffered)
+        self.metrics.incr('bytes_written', len(data))
+        self.buffer = []
+        self.buffered = 0
+
+
+    def close_shard(self):
+        self.flush()
+        if self.compressor is not None:
+            data = self.compressor.flush()
+            self.shard.write(data)
+            self.metrics.incr('bytes_written', len(data))
+            self.compressor = None
+        self.shard.close()
+        self.shard = None
+
+        path = self.shard_path(len(self.paths))
+        os.replace(path + '.part', path)
+        self.paths.append(path)
+        self.logger.info("{0} written, {1} actions".format(path, self.shard_actions))
+
+
+
+class SQLiteDataStorer(DataStorer):
+    """
+    Store the rows into a table of a local sqlite database, for offline
+    queries and aggregations that need no ElasticSearch cluster.
+
+    Columns are the fields of the rows, as text, unique_id being the primary key:
+    rows already in the table are replaced, DeletedRows removed.
+    Indexes on the fields most aggregated on are built at the end of the import.
+    """
+
+    # fields indexed, when among the columns: the storici files
+    # name the codes of the areas cod_regione, cod_provincia, cod_comune
+    indexed_fields = (
+        'codice_fiscale', 'descrizione_carica',
+        'codice_regione', 'codice_provincia', 'codice_comune',
+        'cod_regione', 'cod_provincia', 'cod_comune',
+    )
+
+    def __init__(self, path, table='incarico', batchsize=10000, metrics=None, log_level='info'):
+        DataStorer.__init__(self)
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.log_level = log_level
+        self.logger.setLevel(getattr(logging, self.log_level.upper(), logging.WARNING))
+
+        self.path = path
+        self.table = table
+        self.batchsize = batchsize
+        self.columns = None
+        self.delete_sql = 'DELETE FROM {0} WHERE unique_id=?;'.format(self.quote(table))
+
+        self.con = sqlite3.connect(path)
+        # readers don't block the import, and the import doesn't sync each commit
+        self.con.execute('PRAGMA journal_mode=WAL;')
+        self.con.execute('PRAGMA synchronous=NORMAL;')
+
+
+    def quote(self, name):
+        return '"{0}"'.format(name.replace('"', '""'))
+
+
+    def setup(self, row):
+        """
+        Create the table out of the fields of the first row,
+        or add the fields missing from the table.
         """
+        self.columns = ['unique_id'] + [field for field in row if field != 'unique_id']
+        existing = [r[1] for r in self.con.execute(
+            'PRAGMA table_info({0});'.format(self.quote(self.table))
+        )]
+        with self.con:
+            if not existing:
+                self.con.execute('CREATE TABLE {0} ({1}, PRIMARY KEY (unique_id));'.format(
+                    self.quote(self.table),
+                    ', '.join('{0} TEXT'.format(self.quote(c)) for c in self.columns)
+                ))
+            for column in self.columns:
+                if column not in existing and existing:
+                    self.con.execute('ALTER TABLE {0} ADD COLUMN {1} TEXT;'.format(
+                        self.quote(self.table), self.quote(column)
+                    ))
+
+        self.insert_sql = 'INSERT OR REPLACE INTO {0} ({1}) VALUES ({2});'.format(
+            self.quote(self.table),
+            ', '.join(self.quote(c) for c in self.columns),
+            ', '.join('?' for c in self.columns)
+        )
+
 
-        # main loop generating bulk data to upload to elastic search index
-        bulk_data = []
+    def store(self, iterator):
+        self.logger.info("Writing records into {0}, table {1}".format(self.path, self.table))
+        rows, deleted = [], []
         for row in iterator:
             if type(row) == tuple:
                 self.logger.error(row[0])
                 self.logger.error(",".join(row[1].values()))
+                self.metrics.error(row[0])
+                self.metrics.incr('rows_skipped')
                 continue
 
-            row_values = ",".join(row.values())
-            self.logger.debug("Processing:{0}".format(row_values))
+            if isinstance(row, DeletedRow):
+                self.metrics.incr('rows_deleted')
+                deleted.append((row.unique_id,))
+                continue
 
-            bulk_data.append({
-                'index':{
-                    '_index': self.es_index,
-                    '_type': self.es_doctype,
-                    '_id': row.pop('unique_id')
-                }
-            })
-            bulk_data.append(row)
+            if self.columns is None:
+                self.setup(row)
+            self.metrics.incr('rows')
+            rows.append(tuple(row.get(c) for c in self.columns))
+            if len(rows) >= self.batchsize:
+                self.write(rows, deleted)
+                rows, deleted = [], []
 
+        if rows or deleted:
+            self.write(rows, deleted)
 
-        return bulk_data
+        if self.columns is not None:
+            self.create_indexes()
+        self.con.close()
+
+
+    def write(self, rows, deleted):
+        """
+        Write a batch of rows, and remove the deleted ones, in a single transaction.
+        """
+        with self.metrics.stage('sqlite_write'):
+            with self.con:
+                if rows:
+                    self.con.executemany(self.insert_sql, rows)
+                if deleted:
+                    self.con.executemany(self.delete_sql, deleted)
+        self.logger.info("{0} record written".format(self.metrics.counters['rows']))
+
+
+    def create_indexes(self):
+        with self.metrics.stage('sqlite_index'):
+            with self.con:
+                for field in self.indexed_fields:
+                    if field in self.columns:
+                        self.con.execute('CREATE INDEX IF NOT EXISTS {0} ON {1} ({2});'.format(
+                            self.quote("{0}_{1}".format(self.table, field)),
+                            self.quote(self.table), self.quote(field)
+                        ))
 
 
-    def store(self, iterator):
-        # retrieve bulk_data from minint_url
-        bulk_data = self.get_bulk_data(iterator)
 
-        # send bulk_data to elastic search
-        if self.es_batchsize <= 0:
-            self.es_batchsize = int(len(bulk_data) / 2)
-        grouped_bulk_data = grouper(bulk_data, 2*self.es_batchsize)
+def read_bulk_files(paths):
+    """
+    Generate the serialized actions out of NDJSON files written
+    by BulkFileDataStorer, gzip compressed if named .gz.
+    """
+    for path in paths:
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rb') as f:
+            for line in f:
+                # a deleted document has no source line
+                if line.startswith(b'{"delete"'):
+                    yield line
+                else:
+                    yield line + next(f)
+
+
+
+class ESDataStorer(BulkDataStorer):
+
+    # statuses of the bulk requests and of their items worth a retry:
+    # ElasticSearch is overloaded, or a node is temporarily unreachable
+    retry_statuses = (429, 502, 503, 504)
+
+    # base and maximum delay, in seconds, between two attempts
+    retry_backoff = 0.5
+    retry_backoff_max = 30
+
+    # mappings/<doctype>.json holds the mapping of each doctype
+    mappings_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mappings')
+
+    # values ElasticSearch leaves out of the mappings it returns
+    mapping_defaults = {'index': 'analyzed'}
 
+    # the rows are very repetitive: a low level compresses them almost
+    # as well as the default one, for a fraction of the cpu time
+    gzip_level = 3
+
+    def __init__(self, es_url,
+                 es_index, es_doctype,
+                 es_batchsize=0, es_batchbytes=10 * 1024 * 1024,
+                 es_delete=False,
+                 es_versioned=False, es_keep=1,
+                 es_min_ratio=0.5, es_force_publish=False,
+                 es_bulkload=False, es_forcemerge=False,
+                 es_concurrency=1,
+                 es_retries=5, es_rejects=None,
+                 es_gzip=False, json_encoder=None,
+                 es_timeout=60,
+                 es_shards=5, es_replicas=1, es_refresh_interval='1s',
+                 delta_state=None, delta_source=None,
+                 checkpoint=None,
+                 transport=None,
+                 metrics=None,
+                 log_level='info'
+    ):
+        # in versioned mode es_index is the alias, documents are written
+        # into a new index, published under the alias at the end of the import
+        self.es_alias = None
+        if es_versioned:
+            self.es_alias = es_index
+            es_index = "{0}_{1}".format(self.es_alias, datetime.now().strftime('%Y%m%d%H%M%S'))
+
+        BulkDataStorer.__init__(
+            self, es_index, es_doctype,
+            json_encoder=json_encoder, metrics=metrics, log_level=log_level
+        )
+
+        self.es_url = es_url
+        self.es_batchsize = es_batchsize
+        self.es_batchbytes = es_batchbytes
+        self.es_delete = es_delete
+        self.es_versioned = es_versioned
+        self.es_keep = es_keep
+        self.es_min_ratio = es_min_ratio
+        self.es_force_publish = es_force_publish
+        # a new version is already created write-optimized
+        self.es_bulkload = es_bulkload and not es_versioned
+        self.es_forcemerge = es_forcemerge
+        self.es_concurrency = es_concurrency
+        self.es_retries = es_retries
+        self.es_gzip = es_gzip
+
+        # settings of the indices created
+        self.es_shards = es_shards
+        self.es_replicas = es_replicas
+        self.es_refresh_interval = es_refresh_interval
+
+        # documents ElasticSearch refused are appended here, if given
+        self.es_rejects = es_rejects
+        self.rejects_file = None
+        # unique_ids of the documents refused, not to be taken as ingested
+        self.rejected = set()
+
+        # with a checkpoint, the position in the source is saved after each batch:
+        # a delta state leaves rows out, the position would count the rows sent
+        if checkpoint is not None and delta_state:
+            raise DataStorerException("A checkpoint can't be kept together with a delta state")
+        self.checkpoint = checkpoint
+
+        # _ids of the documents indexed, collected by the sending threads:
+        # a request sent again may find them already there, with status 200
+        self.indexed = set()
+        self.lock = threading.Lock()
+
+        # index settings changed during a bulk load, restored at its end
+        self.saved_settings = None
+
+        # es_url is a node url, or a list of them;
+        # the transport to them may be shared with other storers
+        self.es_urls = es_url.split(',') if isinstance(es_url, str) else list(es_url)
+        if transport is None:
+            from utils.transport import Transport
+            transport = Transport(
+                self.es_urls, pool_size=self.es_concurrency + 1, timeout=es_timeout
+            )
+        self.transport = transport
+
+        self.es_setup()
+
+        # with a delta state, only rows changed since the last run are sent
+        self.delta = None
+        if delta_state:
+            # versions of an alias share its state, replaced at each import;
+            # the sources of a target each have their own, or the rows of the
+            # other sources would look gone from the source being imported
+            scope = "{0}/{1}".format(self.es_alias or self.es_index, self.es_doctype)
+            if delta_source:
+                scope = "{0}/{1}".format(scope, delta_source)
+            self.delta = DeltaState(delta_state, scope=scope)
+            # a new version is built from scratch
+            if self.es_delete or self.es_versioned:
+                self.delta.reset()
+
+
+
+
+    def batches(self, actions):
+        """
+        Group the serialized actions into batches, closing a batch as soon as
+        it holds es_batchsize actions, or adding an action would make it
+        larger than es_batchbytes. A 0 disables the corresponding limit.
+
+        Sizes are the uncompressed ones.
+
+        :return: generator of tuples (list of actions, position in the source
+          after the last action: offset and unique_id)
+        """
+        batch, batch_bytes, position = [], 0, None
+        for action in actions:
+            if batch and self.es_batchbytes and batch_bytes + len(action) > self.es_batchbytes:
+                self.metrics.incr('bytes_serialized', batch_bytes)
+                yield batch, position
+                batch, batch_bytes = [], 0
+
+            if self.es_batchbytes and len(action) > self.es_batchbytes:
+                self.logger.warning(
+                    "Action of {0} bytes exceeds the batch size limit, sent alone".format(len(action))
+                )
+
+            batch.append(action)
+            batch_bytes += len(action)
+            position = (self.offset, self.last_unique_id)
+            if len(batch) == self.es_batchsize:
+                self.metrics.incr('bytes_serialized', batch_bytes)
+                yield batch, position
+                batch, batch_bytes = [], 0
+
+        if batch:
+            self.metrics.incr('bytes_serialized', batch_bytes)
+            yield batch, position
+
+
+    def store(self, iterator, offset=0):
+        """
+        :param iterator: the rows to store
+        :param offset: number of rows of the source skipped, when resuming
+        """
+        self.offset = offset
+        if self.delta is not None:
+            iterator = self.delta.filter(iterator)
+
+        self.send_actions(self.get_bulk_data(iterator))
+
+        if self.checkpoint is not None:
+            self.checkpoint.clear()
+
+        if self.delta is not None:
+            self.delta.commit(rejected=self.rejected)
+            self.logger.info(
+                "Delta: {added} added, {changed} changed, "
+                "{unchanged} unchanged, {removed} removed".format(**self.delta.counts)
+            )
+
+
+    def load(self, paths, readers=1):
+        """
+        Send the actions of the NDJSON files written by BulkFileDataStorer.
+
+        With more readers, the files are split among them, each one reading
+        and decompressing its files in a thread of its own, and their actions
+        are sent as they come: the files must then be the shards of a single
+        import, as the order of the actions of different files is not kept.
+
+        :param paths: paths of the files, read one after the other by each reader
+        :param readers: number of files read concurrently
+        """
+        readers = max(1, min(readers, len(paths)))
+        self.logger.info("Loading {0} bulk files, {1} at a time".format(len(paths), readers))
+
+        def actions():
+            if readers == 1:
+                read = read_bulk_files(paths)
+            else:
+                read = merge([read_bulk_files(paths[i::readers]) for i in range(readers)])
+            for action in read:
+                self.metrics.incr('rows')
+                yield action
+
+        self.send_actions(actions())
+
+
+    def send_actions(self, actions):
+        """
+        Send the serialized actions in batches, suspending the refresh
+        in bulk-load mode, and publish the new index in versioned mode.
+        """
         self.logger.info(
-            "Sending {0} record to elastic search instance, batch_size: {1}".format(
-                int(len(bulk_data)/2), self.es_batchsize
+            "Sending records to elastic search instance, batch_size: {0}, batch_bytes: {1}".format(
+                self.es_batchsize, self.es_batchbytes
             )
         )
 
+        if self.es_bulkload:
+            self.suspend_refresh()
+
+        try:
+            self.send_batches(self.batches(actions))
+        except Exception:
+            if self.es_versioned:
+                self.logger.error(
+                    "Import failed, alias {0} left untouched, {1} can be deleted".format(
+                        self.es_alias, self.es_index
+                    )
+                )
+            raise
+        finally:
+            if self.es_bulkload:
+                self.restore_refresh()
+            if self.rejects_file is not None:
+                self.rejects_file.close()
+                self.rejects_file = None
+
+        if self.es_versioned:
+            self.publish()
+
+
+
+    def send_batches(self, batches):
+        """
+        Send the batches with up to es_concurrency requests in flight,
+        while the following batch is built: rows are pulled and serialized
+        in this thread, as the sending threads wait for ElasticSearch.
+
+        Once all the senders are busy, the oldest request is waited for,
+        so that no more than es_concurrency + 1 batches are held in memory.
+        Results are reported, and checkpoints saved, in the order
+        the batches were built.
+        """
         c = 0
-        for group in grouped_bulk_data:
-            cleaned_group = [g for g in group if g]
-            datastring = "\n".join(map(json.dumps, cleaned_group)) + "\n"
-            self.est._bulk.post(data=datastring,format=(None, 'json'))
-            self.est.post('{0}/_refresh'.format(self.es_index))
-            c += int(len(cleaned_group)/2)
-            self.logger.info("{0} record sent".format(c))
+        with ThreadPoolExecutor(self.es_concurrency) as executor:
+            pending = collections.deque()
+            for batch, position in batches:
+                if len(pending) >= self.es_concurrency:
+                    c += self.wait_batch(pending.popleft())
+                    self.logger.info("{0} record sent".format(c))
+                pending.append(
+                    (len(batch), position, executor.submit(self.send_batch, batch))
+                )
+            while pending:
+                c += self.wait_batch(pending.popleft())
+                self.logger.info("{0} record sent".format(c))
+
+
+    def wait_batch(self, sending):
+        """
+        Wait for a batch to be sent, raising its error if it failed,
+        and save the position it brought the import to.
+        :return: number of actions in the batch
+        """
+        size, position, future = sending
+        with self.metrics.stage('es_wait'):
+            future.result()
+        if self.checkpoint is not None:
+            self.checkpoint.save(*position)
+        return size
+
+
+    def serialize(self, actions):
+        """
+        Build the body of a _bulk request out of serialized actions,
+        gzip compressed with es_gzip. Actions are compressed one by one,
+        so that the uncompressed body is never built.
+        """
+        if not self.es_gzip:
+            return b"".join(actions)
 
+        compressor = zlib.compressobj(self.gzip_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        body = [compressor.compress(action) for action in actions]
+        body.append(compressor.flush())
+        return b"".join(body)
+
+
+    def send_batch(self, actions):
+        """
+        Send a batch of serialized actions and check the outcome of each one.
+
+        The whole batch is sent again if the request fails with a
+        retriable status; only the actions ElasticSearch rejected
+        because overloaded are sent again when the request succeeds.
+        Attempts are spaced out with an exponential, jittered backoff.
+        Actions failing for any other reason, or after es_retries
+        attempts, are rejected.
+
+        :raise RequestException: if the request can't be sent,
+          not even after es_retries attempts
+        """
+        # requests is imported once there's something to send
+        from requests.exceptions import RequestException
+
+        for attempt in range(self.es_retries + 1):
+            if attempt:
+                self.backoff(attempt)
+
+            try:
+                response = self.post_bulk(self.serialize(actions))
+            except RequestException as e:
+                if attempt == self.es_retries or not self.is_retriable(e):
+                    raise
+                self.logger.warning("Bulk request failed, retrying: {0}".format(e))
+                self.metrics.incr('bulk_retries')
+                continue
+
+            actions = self.check_items(actions, response, final=(attempt == self.es_retries))
+            if not actions:
+                break
+            self.logger.warning("{0} actions rejected by an overloaded node, retrying".format(len(actions)))
+
+        # in bulk-load mode, and in a new version, the index is refreshed once, at the end
+        if not (self.es_bulkload or self.es_versioned):
+            with self.metrics.stage('es_refresh'):
+                self.transport.post('{0}/_refresh'.format(self.es_index))
+
+
+    def post_bulk(self, body):
+        """
+        :return: the parsed response of the _bulk request
+        """
+        headers = {'Content-Encoding': 'gzip'} if self.es_gzip else None
+        start = time.perf_counter()
+        with self.metrics.stage('es_bulk'):
+            response = self.transport.post(
+                '{0}/{1}/_bulk'.format(self.es_index, self.es_doctype), data=body, headers=headers
+            )
+        self.metrics.observe('es_bulk_latency_seconds', time.perf_counter() - start)
+        self.metrics.incr('bulk_requests')
+        self.metrics.incr('bytes_sent', len(body))
+        return response
+
+
+    def is_retriable(self, exception):
+        from requests.exceptions import HTTPError
+        if isinstance(exception, HTTPError):
+            return exception.response is not None and \
+                exception.response.status_code in self.retry_statuses
+        return True
+
+
+    def backoff(self, attempt):
+        # half of the delay is fixed, half random, so that
+        # concurrent senders don't retry all at the same time
+        delay = min(self.retry_backoff_max, self.retry_backoff * 2 ** (attempt - 1))
+        time.sleep(delay / 2 + random.uniform(0, delay / 2))
+
+
+    def check_items(self, actions, response, final=False):
+        """
+        Count the outcome of each action, out of the items of a _bulk
+        response, listed in the same order as the actions.
+
+        :param final: True if the actions are not going to be retried
+        :return: list of the actions to retry
+        """
+        if not response.get('errors'):
+            self.metrics.incr('items_ok', len(actions))
+            if self.es_versioned:
+                self.count_indexed([
+                    result['_id'] for item in response['items']
+                    for op, result in item.items() if op != 'delete'
+                ])
+            return []
+
+        retry = []
+        indexed = []
+        for action, item in zip(actions, response['items']):
+            (op, result), = item.items()
+            status = result.get('status', 0)
+
+            if status < 300:
+                self.metrics.incr('items_ok')
+                if op != 'delete':
+                    indexed.append(result.get('_id'))
+            elif op == 'delete' and status == 404:
+                # already gone
+                self.metrics.incr('items_not_found')
+            elif not final and (
+                status in self.retry_statuses or
+                'es_rejected_execution' in json.dumps(result.get('error'))
+            ):
+                retry.append(action)
+            else:
+                self.reject(action, status, result.get('error'), result.get('_id'))
+
+        if retry:
+            self.metrics.incr('items_retried', len(retry))
+        if indexed and self.es_versioned:
+            self.count_indexed(indexed)
+        return retry
+
+
+    def count_indexed(self, ids):
+        with self.lock:
+            self.indexed.update(ids)
+
+
+    def reject(self, action, status, error, unique_id=None):
+        """
+        Log an action that failed for good, remember its unique_id and,
+        with es_rejects, append it to the rejects file, together with the error.
+        Each line of the file holds the status, the error,
+        the action and, if any, the document.
+        """
+        self.metrics.incr('items_rejected')
+        self.logger.error("Rejected, status {0}: {1}".format(status, error))
+        with self.lock:
+            self.rejected.add(unique_id)
+        if not self.es_rejects:
+            return
+
+        lines = [json.loads(line) for line in action.splitlines()]
+        reject = {'status': status, 'error': error, 'action': lines[0]}
+        if len(lines) > 1:
+            reject['source'] = lines[1]
+
+        with self.lock:
+            if self.rejects_file is None:
+                self.rejects_file = open(self.es_rejects, 'a')
+            self.rejects_file.write(json.dumps(reject) + "\n")
+
+
+    def aliased_indices(self, alias):
+        """
+        :return: list of the indices the alias points to
+        """
+        from requests.exceptions import HTTPError
+        try:
+            return list(self.transport.get('_alias/{0}'.format(alias)).keys())
+        except HTTPError as e:
+            if e.response.status_code == 404:
+                return []
+            raise
+
+
+    def versions(self):
+        """
+        :return: list of the versioned indices of the alias, oldest first
+        """
+        version_re = re.compile(r'^{0}_\d{{14}}$'.format(re.escape(self.es_alias)))
+        indices = self.transport.get('{0}_*/_aliases'.format(self.es_alias))
+        return sorted(index for index in indices.keys() if version_re.match(index))
+
+
+    def versioned_setup(self):
+        """
+        Create the index of the new version, with write-optimized settings:
+        no refresh and no replicas during the import.
+        The settings to restore are taken from the current version.
+
+        :raise DataStorerException: if an index, not an alias, has the alias' name
+        """
+        from requests.exceptions import HTTPError
+        current = self.aliased_indices(self.es_alias)
+        if not current:
+            try:
+                self.transport.head(self.es_alias)
+            except HTTPError as e:
+                if e.response.status_code != 404:
+                    raise
+            else:
+                raise DataStorerException(
+                    "{0} is an index, not an alias: it must be removed "
+                    "before switching to versioned indices".format(self.es_alias)
+                )
+
+        replicas = self.es_replicas
+        if current:
+            settings = self.transport.get('{0}/_settings'.format(current[0]))
+            replicas = settings[current[0]].get('settings', {}).get('index', {}).get(
+                'number_of_replicas', replicas
+            )
+        self.saved_settings = {
+            'refresh_interval': self.es_refresh_interval, 'number_of_replicas': replicas
+        }
+
+        index_body = self.index_body()
+        index_body['settings']['index'].update({'refresh_interval': '-1', 'number_of_replicas': 0})
+        self.transport.put(self.es_index, data=index_body)
+        self.logger.info("Index {0} created, alias {1} currently on {2}".format(
+            self.es_index, self.es_alias, ", ".join(current) or "no index"
+        ))
+
+
+    def publish(self):
+        """
+        Make the new version live: restore its settings, check that it holds
+        all the documents indexed, then move the alias onto it, in a single
+        atomic request, and delete the versions exceeding es_keep.
+
+        Unless es_force_publish, an empty new version, or one holding less
+        than es_min_ratio of the documents of the current one, is not published:
+        a source gone wrong would empty the alias.
+
+        The new version only holds the doctype loaded by this import:
+        any other doctype under the alias is not there anymore after the swap.
+
+        :raise DataStorerException: if the documents are not all there,
+          or too few; the alias is not moved, then
+        """
+        self.transport.put('{0}/_settings'.format(self.es_index), data={'index': self.saved_settings})
+        with self.metrics.stage('es_refresh'):
+            self.transport.post('{0}/_refresh'.format(self.es_index))
+
+        count = self.transport.get('{0}/_count'.format(self.es_index))['count']
+        if count != len(self.indexed):
+            raise DataStorerException(
+                "{0} holds {1} documents, {2} were indexed: alias {3} left untouched".format(
+                    self.es_index, count, len(self.indexed), self.es_alias
+                )
+            )
+
+        current = self.aliased_indices(self.es_alias)
+        if not self.es_force_publish:
+            current_count = self.transport.get('{0}/_count'.format(self.es_alias))['count'] if current else 0
+            if count == 0 or count < current_count * self.es_min_ratio:
+                raise DataStorerException(
+                    "{0} holds {1} documents, alias {2} holds {3}: alias left untouched, "
+                    "force the publication if the drop is expected".format(
+                        self.es_index, count, self.es_alias, current_count
+                    )
+                )
+        self.transport.post('_aliases', data={'actions': [
+            {'remove': {'index': index, 'alias': self.es_alias}} for index in current
+        ] + [
+            {'add': {'index': self.es_index, 'alias': self.es_alias}}
+        ]})
+        self.logger.info("Alias {0} moved onto {1}, {2} documents".format(
+            self.es_alias, self.es_index, count
+        ))
+
+        # the new version and the es_keep previous ones are kept
+        old_versions = [index for index in self.versions() if index != self.es_index]
+        for index in old_versions[:max(len(old_versions) - self.es_keep, 0)]:
+            self.transport.delete(index)
+            self.logger.info("Old version {0} deleted".format(index))
+
+
+    def suspend_refresh(self):
+        """
+        Save the refresh interval and the number of replicas of the index,
+        then disable both for the duration of a bulk load.
+        """
+        settings = self.transport.get('{0}/_settings'.format(self.es_index))
+
+        # the response is keyed by the concrete index, es_index may be an alias
+        index_settings = {}
+        for index_name, value in settings.items():
+            index_settings = value.get('settings', {}).get('index', {})
+
+        # a setting never changed is missing, None restores its default
+        self.saved_settings = {
+            'refresh_interval': index_settings.get('refresh_interval'),
+            'number_of_replicas': index_settings.get('number_of_replicas'),
+        }
+        self.transport.put('{0}/_settings'.format(self.es_index), data={
+            'index': {'refresh_interval': '-1', 'number_of_replicas': 0}
+        })
+        self.logger.info(
+            "Bulk load: refresh and replicas suspended, saved settings: {0}".format(self.saved_settings)
+        )
+
+
+    def restore_refresh(self):
+        """
+        Restore the settings saved by suspend_refresh, refresh the index
+        and optionally merge its segments into one.
+        """
+        self.transport.put('{0}/_settings'.format(self.es_index), data={'index': self.saved_settings})
+        self.logger.info("Bulk load: settings restored")
+
+        with self.metrics.stage('es_refresh'):
+            self.transport.post('{0}/_refresh'.format(self.es_index))
+
+        if self.es_forcemerge:
+            with self.metrics.stage('es_forcemerge'):
+                self.transport.post(
+                    '{0}/_forcemerge'.format(self.es_index), params={'max_num_segments': 1}
+                )
+            self.logger.info("Bulk load: segments merged")
 
 
     def es_setup(self):
@@ -135,16 +1003,21 @@ class ESDataStorer(DataStorer):
         :param version:
         :return:
         """
+        from requests.exceptions import HTTPError
+        if self.es_versioned:
+            return self.versioned_setup()
+
         # create politici_version index, if non-existing
         try:
-            self.est.head(self.es_index)
+            self.transport.head(self.es_index)
         except HTTPError as e:
             if e.response.status_code == 401:
                 self.logger.error(e)
                 quit()
             elif e.response.status_code == 404:
-                self.est.put(self.es_index)
+                self.transport.put(self.es_index, data=self.index_body())
                 self.logger.info("Index created")
+                return
             else:
                 self.logger.error(e)
                 quit()
@@ -155,8 +1028,8 @@ class ESDataStorer(DataStorer):
         # remove all docs of type given, if present
         if self.es_delete:
             try:
-                self.est.head(self.es_index)
-                self.est.delete("{0}/{1}".format(self.es_index, self.es_doctype))
+                self.transport.head(self.es_index)
+                self.transport.delete("{0}/{1}".format(self.es_index, self.es_doctype))
             except HTTPError as e:
                 err = e.response
                 if err.status_code == 404:
@@ -164,16 +1037,140 @@ class ESDataStorer(DataStorer):
                 else:
                     quit()
 
+        self.put_mapping()
+
+
+    def load_mapping(self):
+        """
+        Read the mapping of the doctype from the mappings directory.
+        Fields not in the mapping are kept in the documents' source,
+        but not indexed: their types are never guessed.
+
+        :return: the mapping, None if there's no file for the doctype
+        """
+        path = os.path.join(self.mappings_dir, "{0}.json".format(self.es_doctype))
+        if not os.path.exists(path):
+            self.logger.warning("No mapping in {0}, types will be guessed".format(path))
+            return None
+
+        with open(path) as f:
+            mapping = json.load(f)['mappings'][self.es_doctype]
+        mapping.setdefault('dynamic', False)
+        return mapping
+
+
+    def index_body(self):
+        """
+        :return: settings and mappings of a new index
+        """
+        body = {'settings': {'index': {
+            'number_of_shards': self.es_shards,
+            'number_of_replicas': self.es_replicas,
+            'refresh_interval': self.es_refresh_interval,
+        }}}
+        mapping = self.load_mapping()
+        if mapping is not None:
+            body['mappings'] = {self.es_doctype: mapping}
+        return body
+
+
+    def put_mapping(self):
+        """
+        Put the mapping of the doctype into an existing index, if missing,
+        or report how the live one drifted from it.
+        """
+        from requests.exceptions import HTTPError
+        mapping = self.load_mapping()
+        if mapping is None:
+            return
+
+        path = '{0}/_mapping/{1}'.format(self.es_index, self.es_doctype)
+        try:
+            live = self.transport.get(path) or {}
+        except HTTPError as e:
+            if e.response.status_code != 404:
+                raise
+            live = {}
+
+        live_mapping = None
+        for index_name, value in live.items():
+            live_mapping = value.get('mappings', {}).get(self.es_doctype)
+
+        if live_mapping is None:
+            self.transport.put(path, data={self.es_doctype: mapping})
+            self.logger.info("Mapping of {0} put".format(self.es_doctype))
+            return
+
+        drift = self.mapping_drift(mapping['properties'], live_mapping.get('properties', {}))
+        for difference in drift:
+            self.logger.warning("Mapping drift, {0}".format(difference))
+        self.metrics.incr('mapping_drift', len(drift))
+
+
+    def mapping_drift(self, expected, live, prefix=''):
+        """
+        Compare the properties of a mapping with the live ones.
+
+        :return: list of the differences
+        """
+        drift = []
+        for field, definition in expected.items():
+            name = prefix + field
+            if field not in live:
+                drift.append("{0}: not in the live mapping".format(name))
+                continue
+            for key, value in definition.items():
+                if key in ('fields', 'properties'):
+                    drift.extend(self.mapping_drift(value, live[field].get(key, {}), name + '.'))
+                    continue
+                live_value = live[field].get(key, self.mapping_defaults.get(key))
+                if str(value).lower() != str(live_value).lower():
+                    drift.append("{0}: {1} is {2}, {3} expected".format(name, key, live_value, value))
+
+        for field in live:
+            if field not in expected:
+                drift.append("{0}: not in the mapping file".format(prefix + field))
+        return drift
+
+
+
+class NullDataStorer(ESDataStorer):
+    """
+    An ESDataStorer talking to no ElasticSearch: the bulk requests are built
+    and compressed exactly as they would be sent, then discarded.
+    To profile the reading, parsing and enrichment of an archive,
+    or to check a new archive format, without a cluster.
+    """
+
+    def __init__(self, *args, **kwargs):
+        # largest body of a bulk request, as it would be sent
+        self.batch_bytes_max = 0
+        ESDataStorer.__init__(self, *args, **kwargs)
+
+
+    def es_setup(self):
+        pass
+
+
+    def suspend_refresh(self):
+        pass
+
+
+    def restore_refresh(self):
+        pass
 
-        # generate alias, pointing to versioned index
-        # self.est._aliases.post(data={
-        #         "actions": [
-        #         { "add": {
-        #             "alias": "{0}".format(self.es_index),
-        #             "index": "{0}_{1}".format(self.es_index, self.es_version)
-        #         }}
-        #     ]
-        # })
 
+    def publish(self):
+        pass
 
 
+    def send_batch(self, actions):
+        with self.metrics.stage('es_bulk'):
+            body = self.serialize(actions)
+        self.metrics.incr('bulk_requests')
+        self.metrics.incr('bytes_sent', len(body))
+        self.metrics.incr('items_ok', len(actions))
+        with self.lock:
+            if len(body) > self.batch_bytes_max:
+                self.batch_bytes_max = len(body)
+                self.metrics.gauge('batch_bytes_max', len(body))
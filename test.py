@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""
+Regression tests of the fast paths building unique ids and parsing dates:
+their results must be identical to the ones of slugify and strptime,
+as the ids of the documents already imported must not change.
+
+Tests of the storers, against stub ElasticSearch nodes.
+"""
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+from slugify import slugify
+import requests
+from benchmarks.es_stub import ESStub
+from scrapers import UniqueIdBuilder
+from storers import BulkFileDataStorer, DataStorerException, ESDataStorer
+from utils import FastDictReaderInsensitive
+from utils.checkpoint import Checkpoint
+from utils.dates import parse_date, compact_date
+from utils.delta import DeltaState, DeletedRow
+
+__author__ = 'guglielmo'
+
+
+class UniqueIdTest(unittest.TestCase):
+    parts = [
+        ['RSSMRA50A15H501X', 'Sindaco', 'comune', 'ROMA', '20130610'],
+        ['RSSMRA50A15H501X', 'Consigliere', 'comune', "SANT'ANGELO D'ALIFE", '20130610'],
+        ['RSSMRA50A15H501X', 'Vice Sindaco', 'comune', 'FORLÌ', '20130610'],
+        ['RSSMRA50A15H501X', 'Assessore', 'comune', 'CANTÙ', '20130610'],
+        ['rssmra50a15h501x', 'Sindaco', 'comune', 'ROMA', '20130610'],
+        ['RSSMRA50A15H501X', 'Presidente &amp; Assessore', 'provincia', 'L&#39;AQUILA', '20130610'],
+        ['RSSMRA50A15H501X', 'Assessore &egrave; delegato', 'regione', '&lt;ND&gt;', '20130610'],
+        ['RSSMRA50A15H501X', '', 'comune', 'ROMA', '20130610'],
+        ['RSSMRA50A15H501X', 'Sindaco', '', '', ''],
+        ['RSSMRA50A15H501X', '--', 'comune', ' ROMA ', '20130610'],
+        ['', 'Sindaco', 'comune', 'ROMA', '20130610'],
+        ['RSS-MRA 50A15', 'Sindaco', 'comune', 'ROMA', '20130610'],
+        ['RSSMRA50A15H50Ì', 'Sindaco', 'comune', 'ROMA', '20130610'],
+        ['RSSMRA50A15H501_', 'Sindaco', 'comune', 'ROMA', '20130610'],
+        ['ÀÈÌÒÙ', 'Commissario straordinario', 'comune', 'ÉÇ', '20130610'],
+    ]
+
+    def test_slugify(self):
+        builder = UniqueIdBuilder()
+        for parts in self.parts:
+            self.assertEqual(builder.build(*parts), slugify("-".join(parts)), parts)
+
+    def test_cached(self):
+        # slugs memoized for a row are the same for the following ones
+        builder = UniqueIdBuilder(maxsize=2)
+        for parts in self.parts * 2:
+            self.assertEqual(builder.build(*parts), slugify("-".join(parts)), parts)
+
+
+class DatesTest(unittest.TestCase):
+    # strptime also takes unpadded and non ascii digits
+    valid = ['15/01/1950', '29/02/2000', '31/12/1999', '01/01/0001', '1/1/1950', '01/1/1950',
+             '1５/01/1950']
+    invalid = ['29/02/1900', '31/04/2013', '00/01/1950', '15/13/1950', '15-01-1950',
+               '', ' 15/01/1950', '15/01/1950 ', '15/01/195', 'aa/bb/cccc']
+
+    def test_parse_date(self):
+        for value in self.valid:
+            self.assertEqual(parse_date(value), datetime.strptime(value, "%d/%m/%Y"), value)
+
+    def test_compact_date(self):
+        for value in self.valid:
+            self.assertEqual(
+                compact_date(value), datetime.strptime(value, "%d/%m/%Y").strftime("%Y%m%d"), value
+            )
+
+    def test_invalid(self):
+        for value in self.invalid:
+            with self.assertRaises(ValueError):
+                datetime.strptime(value, "%d/%m/%Y")
+            with self.assertRaises(ValueError):
+                parse_date(value)
+
+
+def rows(prefix, n, value='x'):
+    return [{'unique_id': '{0}-{1}'.format(prefix, i), 'value': value} for i in range(n)]
+
+
+class DeltaStateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='scrapeit-test-')
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'delta.db')
+
+    def run_delta(self, rows, rejected=(), scope='politici/incarico'):
+        delta = DeltaState(self.path, scope=scope)
+        out = list(delta.filter(iter(rows)))
+        delta.commit(rejected=rejected)
+        return delta.counts, out
+
+    def test_changes(self):
+        self.run_delta(rows('a', 3))
+        changed = rows('a', 3)[1:] + rows('b', 1)
+        changed[0]['value'] = 'y'
+        counts, out = self.run_delta(changed)
+        self.assertEqual(counts, {'added': 1, 'changed': 1, 'unchanged': 1, 'removed': 1})
+        self.assertEqual([row['unique_id'] for row in out[:2]], ['a-1', 'b-0'])
+        self.assertIsInstance(out[2], DeletedRow)
+        self.assertEqual(out[2].unique_id, 'a-0')
+
+    def test_errors_passed_through(self):
+        error = (Exception('wrong'), {'nome': 'x'})
+        counts, out = self.run_delta([error] + rows('a', 1))
+        self.assertIs(out[0], error)
+        self.assertEqual(counts['added'], 1)
+
+    def test_rejected_sent_again(self):
+        self.run_delta(rows('a', 2), rejected=['a-1'])
+        counts, out = self.run_delta(rows('a', 1))
+        self.assertEqual(counts, {'added': 0, 'changed': 0, 'unchanged': 1, 'removed': 1})
+        counts, out = self.run_delta(rows('a', 2), rejected=['a-1'])
+        self.assertEqual(counts['added'], 1)
+
+    def test_reset(self):
+        self.run_delta(rows('a', 2))
+        DeltaState(self.path, scope='politici/incarico').reset()
+        counts, out = self.run_delta(rows('a', 2))
+        self.assertEqual(counts['added'], 2)
+
+    def test_scopes(self):
+        self.run_delta(rows('a', 2), scope='politici/incarico/ammcom.zip')
+        counts, out = self.run_delta(rows('b', 2), scope='politici/incarico/ammprov.zip')
+        self.assertEqual(counts['removed'], 0)
+
+
+class ESDataStorerTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.stub = ESStub().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.stub.stop()
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='scrapeit-test-')
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def storer(self, **kwargs):
+        storer = ESDataStorer(
+            self.stub.url, 'politici', 'incarico', es_batchsize=10, log_level='critical', **kwargs
+        )
+        storer.retry_backoff = 0.01
+        self.addCleanup(storer.transport.close)
+        return storer
+
+    def test_retry_items(self):
+        # only the actions rejected by an overloaded node are sent again
+        self.stub.script(items={'r-3': [429], 'r-7': [429, 429]})
+        storer = self.storer()
+        storer.store(iter(rows('r', 10)))
+        self.assertEqual(self.stub.received(), [
+            ['r-{0}'.format(i) for i in range(10)], ['r-3', 'r-7'], ['r-7']
+        ])
+        self.assertEqual(storer.metrics.counters['items_ok'], 10)
+        self.assertEqual(storer.metrics.counters['items_retried'], 3)
+        self.assertEqual(storer.rejected, set())
+
+    def test_retry_request(self):
+        # the whole batch is sent again, if the request fails
+        self.stub.script(responses=[503])
+        storer = self.storer()
+        storer.store(iter(rows('r', 10)))
+        self.assertEqual(self.stub.received(), [['r-{0}'.format(i) for i in range(10)]] * 2)
+        self.assertEqual(storer.metrics.counters['bulk_retries'], 1)
+        self.assertEqual(storer.metrics.counters['items_ok'], 10)
+
+    def test_rejects(self):
+        # a mapping error is not retried, an overloaded node is up to es_retries times
+        es_rejects = os.path.join(self.dir, 'rejects.ndjson')
+        self.stub.script(items={'r-2': [400], 'r-5': [429, 429, 429]})
+        storer = self.storer(es_retries=2, es_rejects=es_rejects)
+        storer.store(iter(rows('r', 10)))
+        self.assertEqual(self.stub.received(), [
+            ['r-{0}'.format(i) for i in range(10)], ['r-5'], ['r-5']
+        ])
+        self.assertEqual(storer.rejected, {'r-2', 'r-5'})
+        self.assertEqual(storer.metrics.counters['items_rejected'], 2)
+        self.assertEqual(storer.metrics.counters['items_ok'], 8)
+
+        with open(es_rejects) as f:
+            rejects = [json.loads(line) for line in f]
+        self.assertEqual([(r['status'], r['action']['index']['_id']) for r in rejects],
+                         [(400, 'r-2'), (429, 'r-5')])
+        self.assertEqual(rejects[0]['error']['type'], 'mapper_parsing_exception')
+        self.assertEqual(rejects[0]['source'], {'value': 'x'})
+
+    def test_delta_sources(self):
+        # archives sending rows to the same target don't delete each other's rows
+        delta_state = os.path.join(self.dir, 'delta.db')
+        for source, prefix in [('ammcom.zip', 'c'), ('ammprov.zip', 'p'), ('ammcom.zip', 'c')]:
+            storer = self.storer(delta_state=delta_state, delta_source=source)
+            storer.store(iter(rows(prefix, 25)))
+            self.assertEqual(storer.delta.counts['removed'], 0)
+            self.assertEqual(storer.metrics.counters['rows_deleted'], 0)
+
+        storer = self.storer(delta_state=delta_state, delta_source='ammprov.zip')
+        storer.store(iter(rows('p', 20)))
+        self.assertEqual(storer.delta.counts, {'added': 0, 'changed': 0, 'unchanged': 20, 'removed': 5})
+        self.assertEqual(storer.metrics.counters['rows_deleted'], 5)
+
+    def test_resume(self):
+        # the first run is interrupted by the third request failing for good
+        text = "unique_id;value\n" + "".join(
+            "r-{0};x\n{1}".format(i, "\n" if i % 7 == 0 else "") for i in range(35)
+        )
+        path = os.path.join(self.dir, 'checkpoint.json')
+        self.stub.script(responses=[200, 200, 503])
+        storer = self.storer(es_retries=0, checkpoint=Checkpoint(path, 'hash', 'target'))
+        with self.assertRaises(requests.exceptions.HTTPError):
+            storer.store(FastDictReaderInsensitive(io.StringIO(text), delimiter=';'))
+        sent = self.stub.received()[:2]
+
+        # the acknowledged rows are skipped, for the same archive and target only
+        self.assertEqual(Checkpoint(path, 'hash', 'target').resume_offset(), 20)
+        self.assertEqual(Checkpoint(path, 'other hash', 'target').resume_offset(), 0)
+        self.assertEqual(Checkpoint(path, 'hash', 'other target').resume_offset(), 0)
+
+        self.stub.script()
+        checkpoint = Checkpoint(path, 'hash', 'target')
+        offset = checkpoint.resume_offset()
+        reader = FastDictReaderInsensitive(io.StringIO(text), delimiter=';')
+        self.assertEqual(reader.skip(offset), offset)
+        self.storer(checkpoint=checkpoint).store(reader, offset)
+        sent.extend(self.stub.received())
+
+        self.assertEqual([_id for ids in sent for _id in ids], ['r-{0}'.format(i) for i in range(35)])
+        self.assertFalse(os.path.exists(path))
+
+    def test_load_shards(self):
+        # shards read concurrently are all sent, each document once
+        paths = BulkFileDataStorer(self.dir, shard_rows=7, bulk_gzip=True, log_level='critical').store(
+            iter(rows('r', 30))
+        )
+        self.assertEqual(len(paths), 5)
+        self.stub.script()
+        storer = self.storer()
+        storer.load(paths, readers=3)
+        ids = [_id for ids in self.stub.received() for _id in ids]
+        self.assertEqual(sorted(ids), sorted('r-{0}'.format(i) for i in range(30)))
+        self.assertEqual(storer.metrics.counters['rows'], 30)
+
+    def test_skip(self):
+        reader = FastDictReaderInsensitive(io.StringIO("a;b\n1;2\n\n3;4\n5;6\n"), delimiter=';')
+        self.assertEqual(reader.skip(2), 2)
+        self.assertEqual(list(reader), [{'a': '5', 'b': '6'}])
+        reader = FastDictReaderInsensitive(io.StringIO("a;b\n1;2\n"), delimiter=';')
+        self.assertEqual(reader.skip(5), 1)
+
+    def test_checkpoint_delta(self):
+        with self.assertRaises(DataStorerException):
+            self.storer(
+                checkpoint=Checkpoint(os.path.join(self.dir, 'checkpoint.json'), 'hash', 'target'),
+                delta_state=os.path.join(self.dir, 'delta.db')
+            )
+
+
+if __name__ == '__main__':
+    unittest.main()
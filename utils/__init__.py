@@ -1,12 +1,43 @@
 import csv
+import json
+import os
 
 __author__ = 'guglielmo'
 
+
+def configure_logging(path=None):
+    """
+    Configure logging, by the command line scripts only:
+    importing the modules has no side effects.
+
+    :param path: the json configuration, logging.conf.json
+      in the root of the repository by default
+    """
+    import logging.config
+
+    if path is None:
+        path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'logging.conf.json')
+    with open(path) as f:
+        logging.config.dictConfig(json.load(f))
+
 class DictInsensitive(dict):
     # This class overrides the __getitem__ method to automatically strip() and lower() the input key
+    # Keys are stored already normalized, so the normalization is only needed on a miss
 
     def __getitem__(self, key):
-        return dict.__getitem__(self, key.strip().lower())
+        try:
+            return dict.__getitem__(self, key)
+        except KeyError:
+            return dict.__getitem__(self, key.strip().lower())
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or dict.__contains__(self, key.strip().lower())
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
 
 class DictReaderInsensitive(csv.DictReader):
     # This class overrides the csv.fieldnames property.
@@ -16,6 +47,126 @@ class DictReaderInsensitive(csv.DictReader):
     def fieldnames(self):
         return [field.strip().lower() for field in csv.DictReader.fieldnames.fget(self)]
 
-    def next(self):
-        return DictInsensitive(csv.DictReader.next(self))
+    def __next__(self):
+        return DictInsensitive(csv.DictReader.__next__(self))
+
+    next = __next__
+
+class FastDictReaderInsensitive(object):
+    # A csv.DictReader with the same interface of DictReaderInsensitive.
+    # The header is stripped and lowered once, when it is read,
+    # and rows are built zipping the values with the precomputed tuple of keys.
+
+    def __init__(self, f, fieldnames=None, restkey=None, restval=None,
+                 dialect='excel', *args, **kwds):
+        self.reader = csv.reader(f, dialect, *args, **kwds)
+        self.restkey = restkey
+        self.restval = restval
+        self._keys = None
+        if fieldnames is not None:
+            self._keys = tuple(field.strip().lower() for field in fieldnames)
+
+    def __iter__(self):
+        return self
+
+    @property
+    def fieldnames(self):
+        if self._keys is None:
+            try:
+                header = next(self.reader)
+            except StopIteration:
+                return None
+            self._keys = tuple(field.strip().lower() for field in header)
+        return list(self._keys)
+
+    @property
+    def line_num(self):
+        return self.reader.line_num
+
+    def __next__(self):
+        keys = self._keys
+        if keys is None:
+            if self.fieldnames is None:
+                raise StopIteration
+            keys = self._keys
+
+        row = next(self.reader)
+        # skip empty lines, as csv.DictReader does
+        while row == []:
+            row = next(self.reader)
+
+        d = DictInsensitive(zip(keys, row))
+        n_keys, n_values = len(keys), len(row)
+        if n_keys < n_values:
+            d[self.restkey] = row[n_keys:]
+        elif n_keys > n_values:
+            for key in keys[n_values:]:
+                d[key] = self.restval
+        return d
+
+    next = __next__
+
+    def skip(self, n):
+        """
+        Skip n rows, without building them.
+
+        :return: the number of rows actually skipped
+        """
+        skipped = 0
+        if n <= 0 or self.fieldnames is None:
+            return skipped
+        for row in self.reader:
+            # empty lines are not rows
+            if row:
+                skipped += 1
+                if skipped == n:
+                    break
+        return skipped
+
+
+def csv_chunks(f, size, delimiter=',', quotechar='"'):
+    """
+    Split the lines of a csv file into lists of about size lines,
+    each one ending with a complete record: a quoted value may hold
+    line breaks, its record then spans more lines.
+
+    Only the lines with a quote, or inside a quoted value, are scanned,
+    following the quoting rules of csv.reader: a quote opens a quoted
+    value only at the start of the value, and a doubled one is escaped.
+
+    :return: generator of lists of lines
+    """
+    chunk = []
+    quoted = False
+    for line in f:
+        chunk.append(line)
+        if quoted or quotechar in line:
+            quoted = ends_quoted(line, quoted, delimiter, quotechar)
+        if len(chunk) >= size and not quoted:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
 
+def ends_quoted(line, quoted, delimiter=',', quotechar='"'):
+    """
+    :param quoted: True if the line starts inside a quoted value
+    :return: True if the line ends inside a quoted value
+    """
+    # start of a value, unquoted value, quoted value, quote in a quoted value
+    start, unquoted, inside, quote = range(4)
+    state = inside if quoted else start
+    for c in line:
+        if state == inside:
+            if c == quotechar:
+                state = quote
+        elif state == quote and c == quotechar:
+            state = inside
+        elif c == delimiter or c == '\r' or c == '\n':
+            state = start
+        elif state == start and c == quotechar:
+            state = inside
+        else:
+            state = unquoted
+    return state == inside
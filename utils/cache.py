@@ -0,0 +1,101 @@
+import hashlib
+import json
+import os
+import tempfile
+
+__author__ = 'guglielmo'
+
+
+class ArchiveCache(object):
+    """
+    On-disk cache of the archives downloaded from the sources.
+
+    For each url the last downloaded archive is kept, along with
+    its ETag and Last-Modified headers, the sha256 of its content and,
+    for each target it was imported into, the sha256 of the last archive
+    that was completely ingested.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def _key(self, url):
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+    def archive_path(self, url):
+        return os.path.join(self.path, "{0}.zip".format(self._key(url)))
+
+    def meta_path(self, url):
+        return os.path.join(self.path, "{0}.json".format(self._key(url)))
+
+    def get_meta(self, url):
+        try:
+            with open(self.meta_path(url)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def set_meta(self, url, meta):
+        # write and rename, so that an interrupted run never leaves a broken file
+        fd, tmp_path = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self.meta_path(url))
+
+    def conditional_headers(self, url):
+        """
+        Headers for a conditional GET of the url,
+        empty if there is no cached archive to fall back to.
+        """
+        meta = self.get_meta(url)
+        if not os.path.exists(self.archive_path(url)):
+            return {}
+
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+    def store(self, url, response, chunk_size):
+        """
+        Stream the response's content into the cache, computing its hash.
+
+        :return: tuple (open archive file, content hash)
+        """
+        content_hash = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                content_hash.update(chunk)
+                f.write(chunk)
+        os.replace(tmp_path, self.archive_path(url))
+
+        meta = self.get_meta(url)
+        meta.update({
+            'url': url,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'hash': content_hash.hexdigest(),
+        })
+        self.set_meta(url, meta)
+
+        return open(self.archive_path(url), 'rb'), meta['hash']
+
+    def open(self, url):
+        """
+        :return: tuple (open cached archive file, content hash)
+        """
+        return open(self.archive_path(url), 'rb'), self.get_meta(url)['hash']
+
+    def is_ingested(self, url, content_hash, target):
+        # targets are hashed as well, they may contain credentials
+        return self.get_meta(url).get('ingested', {}).get(self._key(target)) == content_hash
+
+    def mark_ingested(self, url, content_hash, target):
+        meta = self.get_meta(url)
+        meta.setdefault('ingested', {})[self._key(target)] = content_hash
+        self.set_meta(url, meta)
@@ -0,0 +1,61 @@
+import datetime
+import hashlib
+import json
+import os
+import tempfile
+
+__author__ = 'guglielmo'
+
+
+class Checkpoint(object):
+    """
+    Progress of an import, saved after each batch acknowledged by the target:
+    the hash of the source archive, the number of rows of the source
+    that have been dealt with and the unique_id of the last one sent.
+
+    An interrupted import can then resume from the first row not acknowledged,
+    provided the source and the target are the same.
+    """
+
+    def __init__(self, path, source_hash, target):
+        self.path = path
+        self.source_hash = source_hash
+        # the target may contain credentials
+        self.target = hashlib.sha1(target.encode('utf-8')).hexdigest()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as f:
+            return json.load(f)
+
+    def resume_offset(self):
+        """
+        :return: the number of rows to skip, 0 if the checkpoint is missing
+          or refers to another source or target
+        """
+        state = self.load()
+        if state.get('source_hash') != self.source_hash or state.get('target') != self.target:
+            return 0
+        return state['offset']
+
+    def save(self, offset, unique_id):
+        state = {
+            'source_hash': self.source_hash,
+            'target': self.target,
+            'offset': offset,
+            'unique_id': unique_id,
+            'updated': datetime.datetime.now().isoformat(),
+        }
+        # write and rename, a checkpoint is never left half written
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        """
+        Remove the checkpoint, once the import is complete.
+        """
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -9,6 +9,11 @@ Questo modulo contiene il motore di calcolo.
 """
 
 from datetime import date
+from functools import lru_cache
+
+# numpy, se installato, e' importato solo al primo lotto che ne ha bisogno
+numpy = None
+tavole_numpy = None
 
 class InvalidDataError(Exception): pass
 
@@ -109,6 +114,90 @@ def codice_fiscale(cognome, nome, nascita, sesso, stato, provincia, comune, db):
     return codice + codice_controllo(codice)
 
 
+# le stesse tavole di controllo, indicizzate per codice del carattere:
+# in posizione dispari (prima, terza, ...) e pari; None per i caratteri non ammessi
+pesi_dispari = [None] * 128
+pesi_pari = [None] * 128
+for _c, (_pari, _dispari) in controllo.items():
+    pesi_dispari[ord(_c)] = _dispari
+    pesi_pari[ord(_c)] = _pari
+
+def _tavole_numpy():
+    """Importa numpy e prepara le tavole di _codici_controllo_numpy, la prima volta.
+    Restituisce None se numpy non e' installato."""
+    global numpy, tavole_numpy
+    if tavole_numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            tavole_numpy = False
+            return None
+        # prima riga: pesi in posizione dispari, seconda: in posizione pari; -1 se non ammesso
+        tavola_pesi = numpy.full((2, 256), -1, dtype=numpy.int16)
+        for i in range(128):
+            if pesi_dispari[i] is not None:
+                tavola_pesi[0, i], tavola_pesi[1, i] = pesi_dispari[i], pesi_pari[i]
+        posizioni = numpy.arange(15) % 2
+        lettere_alfabeto = numpy.frombuffer(alfabeto.encode('ascii'), dtype=numpy.uint8)
+        tavole_numpy = (tavola_pesi, posizioni, lettere_alfabeto)
+    return tavole_numpy or None
+
+def _codici_controllo_numpy(codici, tavole):
+    """codici_controllo su tutto il lotto in una volta, con numpy.
+    Restituisce None se i codici non sono tutti di 15 caratteri."""
+    tavola_pesi, posizioni, lettere_alfabeto = tavole
+    testo = ''.join(codici).encode('latin1', 'replace')
+    if len(testo) != 15 * len(codici):
+        return None
+    caratteri = numpy.frombuffer(testo, dtype=numpy.uint8).reshape(-1, 15)
+    pesi = tavola_pesi[posizioni, caratteri]
+    if (pesi < 0).any():
+        raise InvalidDataError('caratteri non validi in input')
+    resti = pesi.sum(axis=1) % 26
+    return list(lettere_alfabeto[resti].tobytes().decode('ascii'))
+
+def codici_controllo(codici, usa_numpy=True):
+    """Le lettere di controllo di una lista di codici, come codice_controllo.
+    Solleva InvalidDataError se un codice contiene caratteri non ammessi.
+    @param usa_numpy: False per non usare numpy, anche se installato"""
+    tavole = _tavole_numpy() if usa_numpy and codici else None
+    if tavole is not None:
+        lettere = _codici_controllo_numpy(codici, tavole)
+        if lettere is not None:
+            return lettere
+
+    lettere = []
+    for codice in codici:
+        resto = 0
+        try:
+            for n, i in enumerate(codice):
+                resto += (pesi_pari if n % 2 else pesi_dispari)[ord(i)]
+        except (IndexError, TypeError):
+            raise InvalidDataError('caratteri non validi in input')
+        lettere.append(alfabeto[resto % 26])
+    return lettere
+
+# cognomi, nomi e date di nascita si ripetono molto: le parti del codice
+# che ne derivano sono memorizzate
+_codice_cognome = lru_cache(maxsize=65536)(codice_cognome)
+_codice_nome = lru_cache(maxsize=65536)(codice_nome)
+_codice_nascita = lru_cache(maxsize=65536)(codice_nascita)
+
+def codici_fiscali(cognomi, nomi, nascite, sessi, luoghi, usa_numpy=True):
+    """Restituisce la lista dei codici fiscali di un lotto di persone,
+    i cui dati anagrafici sono passati per colonne, ordinate allo stesso modo.
+    Solleva InvalidDataError se nomi o cognomi contengono caratteri non ammessi.
+    @param luoghi: i codici (gia' risolti) dei luoghi di nascita
+    @param usa_numpy: False per non usare numpy, anche se installato
+    """
+    codici = [_codice_cognome(cognome) + _codice_nome(nome) +
+              _codice_nascita(nascita, sesso) + luogo
+              for cognome, nome, nascita, sesso, luogo
+              in zip(cognomi, nomi, nascite, sessi, luoghi)]
+    return [codice + controllo for codice, controllo
+            in zip(codici, codici_controllo(codici, usa_numpy))]
+
+
 if __name__ == '__main__':
     # una piccola interfaccia testuale per giocare un po'...
     import sys
@@ -72,3 +72,34 @@ class Connessione(object):
         return [i[0] for i in self.cur.fetchall()]
 
 
+class IndiceCodici(object):
+    """I codici delle tabelle comuni e stati, caricati in memoria una volta
+    sola, per risparmiare una query per ogni codice fiscale calcolato.
+    codici_geografici ha la stessa signature e lo stesso comportamento
+    di Connessione.codici_geografici."""
+    def __init__(self, db_path=DB):
+        con = Connessione(db_path)
+        try:
+            # a parita' di chiave vale il primo record, come nelle query
+            self.comuni = {}
+            con.cur.execute('SELECT codice, comune, provincia FROM comuni;')
+            for codice, comune, provincia in con.cur.fetchall():
+                self.comuni.setdefault((comune, provincia), codice)
+            self.stati = {}
+            con.cur.execute('SELECT codice, stato FROM stati;')
+            for codice, stato in con.cur.fetchall():
+                self.stati.setdefault(stato, codice)
+        except sqlite3.OperationalError:
+            raise DBQueryError('errore nella query al database')
+        finally:
+            con.chiudi()
+
+    def codici_geografici(self, stato, provincia, comune):
+        if stato == 'ITALIA':
+            key, codici = (comune.upper(), provincia.upper()), self.comuni
+        else:
+            key, codici = stato.upper(), self.stati
+        try:
+            return codici[key]
+        except KeyError:
+            raise DBNoDataError('nessun codice corrisponde ai valori immessi')
@@ -7,7 +7,7 @@ import unittest
 from datetime import date
 from codicefiscale import (codice_cognome, codice_nome, codice_nascita, 
                            codice_geografia, codice_controllo, codice_fiscale,
-                           InvalidDataError)
+                           codici_controllo, codici_fiscali, InvalidDataError)
 import db
 
 class CognomeTest(unittest.TestCase):
@@ -76,6 +76,28 @@ class GeografiaTest(unittest.TestCase):
     def tearDown(self):
         self.con.chiudi()
         
+
+class IndiceTest(GeografiaTest):
+    def setUp(self):
+        self.indice = db.IndiceCodici()
+        self.db = self.indice.codici_geografici
+
+    def test_come_connessione(self):
+        con = db.Connessione()
+        try:
+            for comune, provincia in list(self.indice.comuni)[::50]:
+                self.assertEqual(
+                    self.db('ITALIA', provincia, comune),
+                    con.codici_geografici('ITALIA', provincia, comune))
+            for stato in self.indice.stati:
+                self.assertEqual(self.db(stato, None, None),
+                                 con.codici_geografici(stato, None, None))
+        finally:
+            con.chiudi()
+
+    def tearDown(self):
+        pass
+
                           
 class ControlloTest(unittest.TestCase):
     def test_normale(self): # alcuni codici veri da testare...
@@ -92,15 +114,58 @@ class ControlloTest(unittest.TestCase):
 class FiscaleTest(unittest.TestCase): 
     pass
 
+
+class LottoTest(unittest.TestCase):
+    codici = ('GRPLCR71R24L912N', 'MRARSS34P12A662Z', 'GNNBOX78S63I754Q',
+              'DLAHUX86C50F952H', 'RSMBLL12P65E472F', 'DDDRMO56B12E625V')
+
+    def setUp(self):
+        self.con = db.Connessione()
+
+    def test_controllo(self):
+        for usa_numpy in (False, True):
+            self.assertEqual(
+                codici_controllo([cod[:-1] for cod in self.codici], usa_numpy),
+                [cod[-1] for cod in self.codici])
+
+    def test_caratteri_non_ammessi(self):
+        for usa_numpy in (False, True):
+            with self.assertRaises(InvalidDataError):
+                codici_controllo(['RSSMRA50A15F284', ';-)'], usa_numpy)
+            with self.assertRaises(InvalidDataError):
+                codici_controllo(['RSSMRA50A15F28;', 'RSSMRA50A15F28\xe8'], usa_numpy)
+
+    def test_come_codice_fiscale(self):
+        persone = [(u'Rossi', u'Giovanni', date(1950, 1, 15), 'm', 'BA', 'MOLFETTA'),
+                   (u"D'Andrea", u'Andrea', date(1950, 12, 5), 'f', 'TO', "AGLIE'"),
+                   (u'Noè', u'Al', date(1986, 3, 10), 'F', 'RM', 'ROMA'),
+                   (u'Di Nanni', u'Bo', date(1912, 9, 25), 'M', 'BA', 'MOLFETTA')]
+        attesi = [codice_fiscale(cognome, nome, nascita, sesso, 'ITALIA',
+                                 provincia, comune, self.con.codici_geografici)
+                  for cognome, nome, nascita, sesso, provincia, comune in persone]
+        cognomi, nomi, nascite, sessi, province, comuni = zip(*persone)
+        luoghi = [self.con.codici_geografici('ITALIA', provincia, comune)
+                  for provincia, comune in zip(province, comuni)]
+        for usa_numpy in (False, True):
+            self.assertEqual(
+                codici_fiscali(cognomi, nomi, nascite, sessi, luoghi, usa_numpy),
+                attesi)
+
+    def tearDown(self):
+        self.con.chiudi()
+
 cognome_suite = unittest.TestLoader().loadTestsFromTestCase(CognomeTest)
 nome_suite = unittest.TestLoader().loadTestsFromTestCase(NomeTest)
 nascita_suite = unittest.TestLoader().loadTestsFromTestCase(NascitaTest)
 geografia_suite = unittest.TestLoader().loadTestsFromTestCase(GeografiaTest)
+indice_suite = unittest.TestLoader().loadTestsFromTestCase(IndiceTest)
 controllo_suite = unittest.TestLoader().loadTestsFromTestCase(ControlloTest)
 fiscale_suite = unittest.TestLoader().loadTestsFromTestCase(FiscaleTest)
+lotto_suite = unittest.TestLoader().loadTestsFromTestCase(LottoTest)
 
 all_tests = unittest.TestSuite([cognome_suite, nome_suite, nascita_suite, 
-                                geografia_suite, controllo_suite, fiscale_suite])
+                                geografia_suite, indice_suite, controllo_suite,
+                                fiscale_suite, lotto_suite])
 
 if __name__ == '__main__':
     unittest.TextTestRunner().run(all_tests)
@@ -0,0 +1,30 @@
+from datetime import datetime
+import functools
+
+__author__ = 'guglielmo'
+
+
+@functools.lru_cache(maxsize=65536)
+def parse_date(value):
+    """
+    Parse a dd/mm/YYYY date, as datetime.strptime(value, "%d/%m/%Y") does.
+    Well formed values are split by position, anything else is left to strptime.
+    Results are memoized, as the same dates repeat across the rows.
+
+    :raise ValueError: if the value is not a valid date
+    """
+    if len(value) == 10 and value[2] == '/' and value[5] == '/' and value.isascii():
+        day, month, year = value[0:2], value[3:5], value[6:10]
+        if day.isdigit() and month.isdigit() and year.isdigit():
+            return datetime(int(year), int(month), int(day))
+    return datetime.strptime(value, "%d/%m/%Y")
+
+
+@functools.lru_cache(maxsize=65536)
+def compact_date(value):
+    """
+    Convert a dd/mm/YYYY date into the YYYYmmdd form.
+
+    :raise ValueError: if the value is not a valid date
+    """
+    return parse_date(value).strftime("%Y%m%d")
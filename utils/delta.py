@@ -0,0 +1,101 @@
+import hashlib
+import json
+import sqlite3
+
+__author__ = 'guglielmo'
+
+
+class DeletedRow(object):
+    """
+    Placeholder for a row that was ingested by a previous run,
+    and is no longer in the source.
+    """
+    __slots__ = ('unique_id',)
+
+    def __init__(self, unique_id):
+        self.unique_id = unique_id
+
+
+class DeltaState(object):
+    """
+    Local state of the rows ingested into a target,
+    mapping each unique_id to a hash of the row's content.
+
+    The state is kept in a sqlite file, that may hold many targets,
+    each one identified by its scope (ie: index/doctype).
+    """
+
+    def __init__(self, path, scope):
+        self.con = sqlite3.connect(path)
+        self.con.execute(
+            'CREATE TABLE IF NOT EXISTS rows '
+            '(scope TEXT, unique_id TEXT, hash TEXT, PRIMARY KEY (scope, unique_id));'
+        )
+        self.scope = scope
+        self.counts = {'added': 0, 'changed': 0, 'unchanged': 0, 'removed': 0}
+        self._hashes = None
+
+    @staticmethod
+    def row_hash(row):
+        return hashlib.sha1(json.dumps(row, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def reset(self):
+        """
+        Forget all rows of the scope, they will all be considered new.
+        """
+        with self.con:
+            self.con.execute('DELETE FROM rows WHERE scope=?;', (self.scope,))
+
+    def filter(self, iterator):
+        """
+        Yield only the rows that are new or changed since the last commit,
+        followed by a DeletedRow for each row not found in the iterator.
+        Error tuples are passed through untouched.
+        """
+        old_hashes = dict(self.con.execute(
+            'SELECT unique_id, hash FROM rows WHERE scope=?;', (self.scope,)
+        ))
+        hashes = {}
+        for row in iterator:
+            if type(row) == tuple:
+                yield row
+                continue
+
+            unique_id = row['unique_id']
+            hashes[unique_id] = row_hash = self.row_hash(row)
+            old_hash = old_hashes.pop(unique_id, None)
+            if old_hash is None:
+                self.counts['added'] += 1
+                yield row
+            elif old_hash != row_hash:
+                self.counts['changed'] += 1
+                yield row
+            else:
+                self.counts['unchanged'] += 1
+
+        for unique_id in old_hashes:
+            self.counts['removed'] += 1
+            yield DeletedRow(unique_id)
+
+        self._hashes = hashes
+
+    def commit(self, rejected=()):
+        """
+        Persist the state of the last filtered iterator.
+        To be called once its rows have been successfully stored.
+
+        :param rejected: unique_ids the target refused; they're saved with
+          an empty hash, so that the next run sends them again,
+          as changed rows or, if gone from the source, as deletions
+        """
+        if self._hashes is None:
+            return
+        for unique_id in rejected:
+            self._hashes[unique_id] = ''
+        with self.con:
+            self.con.execute('DELETE FROM rows WHERE scope=?;', (self.scope,))
+            self.con.executemany(
+                'INSERT INTO rows (scope, unique_id, hash) VALUES (?, ?, ?);',
+                ((self.scope, k, v) for k, v in self._hashes.items())
+            )
+        self._hashes = None
@@ -0,0 +1,50 @@
+import collections
+import json
+
+__author__ = 'guglielmo'
+
+# faster json libraries are used when installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+def json_dumps(obj):
+    # ensure_ascii (the default) leaves only ascii characters to encode
+    return json.dumps(obj).encode('ascii')
+
+
+def ujson_dumps(obj):
+    return ujson.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+
+# name -> function serializing an object into utf-8 encoded json bytes,
+# in order of preference
+encoders = collections.OrderedDict()
+if orjson is not None:
+    encoders['orjson'] = orjson.dumps
+if ujson is not None:
+    encoders['ujson'] = ujson_dumps
+encoders['json'] = json_dumps
+
+
+def get_encoder(name=None):
+    """
+    Pick a json encoder: the one named, or the fastest one installed.
+
+    :return: tuple (name, function serializing an object into bytes)
+    :raise ValueError: if the named encoder is not available
+    """
+    if name is None:
+        name = next(iter(encoders))
+    if name not in encoders:
+        raise ValueError(
+            "JSON encoder {0} not available, choose among: {1}".format(name, ", ".join(encoders))
+        )
+    return name, encoders[name]
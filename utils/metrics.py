@@ -0,0 +1,252 @@
+import collections
+import contextlib
+import datetime
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+__author__ = 'guglielmo'
+
+# peak memory is only known where the resource module is
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def peak_rss():
+    """
+    :return: tuple (peak resident set size of this process, largest one
+      of its terminated children), in bytes; (None, None) if unknown
+    """
+    if resource is None:
+        return None, None
+    # kilobytes on linux, bytes on macos
+    unit = 1 if sys.platform == 'darwin' else 1024
+    return (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit,
+    )
+
+
+class StageTiming(object):
+    """
+    Context manager adding the wall and cpu time of a block to a stage.
+    The cpu time is the one of the current thread.
+
+    Reading the cpu clock is a system call: blocks timed once per row
+    only take the wall time.
+    """
+    __slots__ = ('metrics', 'name', 'cpu', 'wall_start', 'cpu_start')
+
+    def __init__(self, metrics, name, cpu=True):
+        self.metrics = metrics
+        self.name = name
+        self.cpu = cpu
+
+    def __enter__(self):
+        self.wall_start = time.perf_counter()
+        if self.cpu:
+            self.cpu_start = time.thread_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.add_stage_time(
+            self.name,
+            time.perf_counter() - self.wall_start,
+            time.thread_time() - self.cpu_start if self.cpu else None
+        )
+
+
+class Metrics(object):
+    """
+    Instrumentation of an import run, shared by the scraper,
+    its reader and the storer: counters, gauges, errors by exception type,
+    wall and cpu time per stage, latency histograms.
+
+    At the end of a run, a summary can be written as json
+    and as a Prometheus textfile.
+    """
+
+    # upper bounds of the latency histograms buckets, in seconds
+    latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self):
+        self.started = datetime.datetime.now()
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        self.counters = collections.Counter()
+        self.gauges = {}
+        self.errors = collections.Counter()
+        self.stages = collections.OrderedDict()
+        self.histograms = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def incr(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def error(self, exception):
+        with self.lock:
+            self.errors[type(exception).__name__] += 1
+
+    def stage(self, name, cpu=True):
+        return StageTiming(self, name, cpu)
+
+    def add_stage_time(self, name, wall, cpu=None):
+        with self.lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = {
+                    'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0 if cpu is not None else None
+                }
+            stage['calls'] += 1
+            stage['wall_s'] += wall
+            if cpu is not None:
+                stage['cpu_s'] += cpu
+
+    def observe(self, name, value):
+        """
+        Add a value, ie: a latency in seconds, to a histogram.
+        """
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = {
+                    'buckets': [0] * len(self.latency_buckets), 'sum': 0.0, 'count': 0
+                }
+            for i, bound in enumerate(self.latency_buckets):
+                if value <= bound:
+                    histogram['buckets'][i] += 1
+                    break
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.start_wall
+        with self.lock:
+            rows = self.counters['rows']
+            stages = collections.OrderedDict()
+            for name, stage in self.stages.items():
+                stages[name] = collections.OrderedDict([
+                    ('calls', stage['calls']),
+                    ('wall_s', round(stage['wall_s'], 6)),
+                    ('cpu_s', round(stage['cpu_s'], 6) if stage['cpu_s'] is not None else None),
+                    ('rows_per_s', round(rows / stage['wall_s'], 1) if stage['wall_s'] else None),
+                ])
+            histograms = collections.OrderedDict()
+            for name, histogram in self.histograms.items():
+                # cumulative counts, as in Prometheus
+                buckets, cumulative = collections.OrderedDict(), 0
+                for bound, count in zip(self.latency_buckets, histogram['buckets']):
+                    cumulative += count
+                    buckets[str(bound)] = cumulative
+                buckets['+Inf'] = histogram['count']
+                histograms[name] = {
+                    'buckets': buckets, 'sum': round(histogram['sum'], 6), 'count': histogram['count']
+                }
+            return collections.OrderedDict([
+                ('started', self.started.isoformat()),
+                ('elapsed_s', round(elapsed, 3)),
+                ('cpu_s', round(time.process_time() - self.start_cpu, 3)),
+                ('rows_per_s', round(rows / elapsed, 1) if elapsed else None),
+                ('counters', collections.OrderedDict(sorted(self.counters.items()))),
+                ('gauges', collections.OrderedDict(sorted(self.gauges.items()))),
+                ('errors', collections.OrderedDict(sorted(self.errors.items()))),
+                ('stages', stages),
+                ('histograms', histograms),
+            ])
+
+    def write(self, path, content):
+        # write and rename, so that a collector never reads a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    def write_json(self, path):
+        self.write(path, json.dumps(self.summary(), indent=2) + "\n")
+
+    def write_prometheus(self, path, prefix='scrapeit', labels=None):
+        """
+        Write the summary in the Prometheus text format,
+        to be picked up by the node_exporter textfile collector.
+        """
+        summary = self.summary()
+
+        def fmt_labels(**extra):
+            all_labels = dict(labels or {}, **extra)
+            if not all_labels:
+                return ''
+            return '{' + ','.join(
+                '{0}="{1}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                for k, v in sorted(all_labels.items())
+            ) + '}'
+
+        lines = []
+
+        def metric(name, kind, samples):
+            lines.append('# TYPE {0}_{1} {2}'.format(prefix, name, kind))
+            for suffix, sample_labels, value in samples:
+                lines.append('{0}_{1}{2}{3} {4}'.format(
+                    prefix, name, suffix, fmt_labels(**sample_labels), value
+                ))
+
+        metric('run_duration_seconds', 'gauge', [('', {}, summary['elapsed_s'])])
+        metric('run_cpu_seconds', 'gauge', [('', {}, summary['cpu_s'])])
+        metric('rows_per_second', 'gauge', [('', {}, summary['rows_per_s'] or 0)])
+        for name, value in summary['counters'].items():
+            metric('{0}_total'.format(name), 'counter', [('', {}, value)])
+        for name, value in summary['gauges'].items():
+            metric(name, 'gauge', [('', {}, value)])
+        metric('errors_total', 'counter', [
+            ('', {'type': error_type}, count) for error_type, count in summary['errors'].items()
+        ])
+        metric('stage_wall_seconds', 'gauge', [
+            ('', {'stage': name}, stage['wall_s']) for name, stage in summary['stages'].items()
+        ])
+        metric('stage_cpu_seconds', 'gauge', [
+            ('', {'stage': name}, stage['cpu_s']) for name, stage in summary['stages'].items()
+            if stage['cpu_s'] is not None
+        ])
+        for name, histogram in summary['histograms'].items():
+            metric(name, 'histogram', [
+                ('_bucket', {'le': bound}, count) for bound, count in histogram['buckets'].items()
+            ] + [
+                ('_sum', {}, histogram['sum']), ('_count', {}, histogram['count'])
+            ])
+
+        self.write(path, "\n".join(lines) + "\n")
+
+
+class NullMetrics(Metrics):
+    """
+    Metrics collecting nothing, for the code paths that are not measured,
+    ie: the readers enriching rows in the worker processes.
+    """
+
+    null_timing = contextlib.nullcontext()
+
+    def incr(self, name, value=1):
+        pass
+
+    def gauge(self, name, value):
+        pass
+
+    def error(self, exception):
+        pass
+
+    def stage(self, name, cpu=True):
+        return self.null_timing
+
+    def observe(self, name, value):
+        pass
+
+null_metrics = NullMetrics()
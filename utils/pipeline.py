@@ -0,0 +1,314 @@
+import collections
+import queue
+import threading
+import time
+
+__author__ = 'guglielmo'
+
+
+class Failure(object):
+    """
+    An exception raised by a producer thread, to be raised again by the consumer.
+    """
+    __slots__ = ('exception',)
+
+    def __init__(self, exception):
+        self.exception = exception
+
+
+# put in the queue by a producer thread that's done
+DONE = object()
+
+
+def merge(iterators, maxsize=16, chunk_size=500):
+    """
+    Iterate over the items of many iterators, each one consumed by a thread
+    of its own, in the order they come: a slow iterator doesn't hold back
+    the others.
+
+    Items are passed over in chunks, through a queue of at most maxsize chunks.
+    An exception raised by an iterator is raised again here;
+    when the iteration is left, the threads stop at their next item.
+    """
+    chunks = queue.Queue(maxsize)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce(iterator):
+        try:
+            chunk = []
+            for item in iterator:
+                chunk.append(item)
+                if len(chunk) >= chunk_size:
+                    if not put(chunk):
+                        return
+                    chunk = []
+            if chunk:
+                put(chunk)
+            put(DONE)
+        except BaseException as e:
+            put(Failure(e))
+
+    threads = [
+        threading.Thread(target=produce, args=(iterator,), daemon=True)
+        for iterator in iterators
+    ]
+    for thread in threads:
+        thread.start()
+
+    try:
+        running = len(threads)
+        while running:
+            chunk = chunks.get()
+            if chunk is DONE:
+                running -= 1
+            elif isinstance(chunk, Failure):
+                raise chunk.exception
+            else:
+                for item in chunk:
+                    yield item
+    finally:
+        stop.set()
+
+
+def parse_parallelism(spec):
+    """
+    Parse the parallelism of the stages of a pipeline, ie: parse=2,enrich=4p
+    for 2 threads parsing and 4 processes enriching; a t suffix, or none, means threads.
+
+    :return: dict stage name -> tuple (workers, processes)
+    :raise ValueError: if the spec is malformed
+    """
+    parallelism = {}
+    for part in spec.split(','):
+        name, sep, value = part.strip().partition('=')
+        if not sep or not name:
+            raise ValueError("Malformed stage parallelism: {0}".format(part))
+        processes = value.endswith('p')
+        workers = int(value.rstrip('pt'))
+        if workers < 1:
+            raise ValueError("A stage needs at least a worker: {0}".format(part))
+        parallelism[name] = (workers, processes)
+    return parallelism
+
+
+class Stage(object):
+    """
+    A step of a Pipeline, applying its function to each chunk of items
+    coming from the previous step, in workers threads or, with processes,
+    in a pool of workers processes: the function, its arguments and
+    results must then be picklable.
+
+    The function returns the list of items passed on to the next step.
+    With more than a worker, chunks are passed on in the order they're done.
+    """
+
+    def __init__(self, name, function, workers=1, processes=False):
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.processes = processes
+
+        # seconds spent by all the workers running the function,
+        # waiting for the input queue to fill, waiting for the output one to empty
+        self.chunks = 0
+        self.items = 0
+        self.busy = 0.0
+        self.starved = 0.0
+        self.blocked = 0.0
+
+        # depth of the input queue, sampled at each get
+        self.depth_samples = 0
+        self.depth_sum = 0
+        self.depth_max = 0
+
+        self.lock = threading.Lock()
+
+    def account(self, chunk=None, busy=0.0, starved=0.0, blocked=0.0, depth=None):
+        with self.lock:
+            if chunk is not None:
+                self.chunks += 1
+                self.items += len(chunk)
+            self.busy += busy
+            self.starved += starved
+            self.blocked += blocked
+            if depth is not None:
+                self.depth_samples += 1
+                self.depth_sum += depth
+                self.depth_max = max(self.depth_max, depth)
+
+    def stats(self):
+        return collections.OrderedDict([
+            ('workers', "{0}{1}".format(self.workers, 'p' if self.processes else 't')),
+            ('chunks', self.chunks),
+            ('items', self.items),
+            ('busy_s', round(self.busy, 3)),
+            ('starved_s', round(self.starved, 3)),
+            ('blocked_s', round(self.blocked, 3)),
+            ('queue_avg', round(self.depth_sum / self.depth_samples, 2) if self.depth_samples else None),
+            ('queue_max', self.depth_max),
+        ])
+
+
+class Pipeline(object):
+    """
+    Producer/consumer pipeline: a source, read by a thread of its own,
+    stages, each one run by its own workers, and a sink, consuming
+    the items out of the last stage in the calling thread.
+    Steps are connected by queues of at most maxsize chunks, so that
+    a slow step holds back the previous ones, instead of piling up items.
+
+    For each step, the time spent working, starved for input
+    and blocked on output, and the depth of its input queue
+    are measured: the bottleneck is the one never starved,
+    while those before it are blocked.
+    """
+
+    def __init__(self, stages, maxsize=8, metrics=None, source_name='source', sink_name='sink'):
+        self.stages = stages
+        self.maxsize = maxsize
+        self.metrics = metrics
+        self.source = Stage(source_name, None)
+        self.sink = Stage(sink_name, None)
+        self.stop = threading.Event()
+
+    def put(self, queue_, item, step):
+        start = time.perf_counter()
+        while not self.stop.is_set():
+            try:
+                queue_.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        step.account(blocked=time.perf_counter() - start)
+        return not self.stop.is_set()
+
+    def get(self, queue_, step):
+        depth = queue_.qsize()
+        start = time.perf_counter()
+        item = queue_.get()
+        step.account(starved=time.perf_counter() - start, depth=depth)
+        return item
+
+    def produce(self, source, output_queue, consumers):
+        try:
+            start = time.perf_counter()
+            for chunk in source:
+                self.source.account(chunk, busy=time.perf_counter() - start)
+                if not self.put(output_queue, chunk, self.source):
+                    return
+                start = time.perf_counter()
+            for _ in range(consumers):
+                self.put(output_queue, DONE, self.source)
+        except BaseException as e:
+            self.put(output_queue, Failure(e), self.source)
+
+    def work(self, stage, executor, input_queue, output_queue, consumers, running):
+        try:
+            while True:
+                chunk = self.get(input_queue, stage)
+                if chunk is DONE:
+                    break
+                if isinstance(chunk, Failure):
+                    self.put(output_queue, chunk, stage)
+                    return
+
+                start = time.perf_counter()
+                if executor is not None:
+                    result = executor.submit(stage.function, chunk).result()
+                else:
+                    result = stage.function(chunk)
+                stage.account(chunk, busy=time.perf_counter() - start)
+                if not self.put(output_queue, result, stage):
+                    return
+
+            # the last worker of a stage done tells the next stage
+            with stage.lock:
+                running[0] -= 1
+                last = running[0] == 0
+            if last:
+                for _ in range(consumers):
+                    self.put(output_queue, DONE, stage)
+        except BaseException as e:
+            self.put(output_queue, Failure(e), stage)
+
+    def items(self, input_queue):
+        while True:
+            chunk = self.get(input_queue, self.sink)
+            if chunk is DONE:
+                return
+            if isinstance(chunk, Failure):
+                raise chunk.exception
+            start = time.perf_counter()
+            self.sink.account(chunk)
+            for item in chunk:
+                yield item
+            # the time the sink spends on the chunk is the one between two gets
+            self.sink.account(busy=time.perf_counter() - start)
+
+    def run(self, source, sink):
+        """
+        :param source: iterable of chunks, ie: lists, of items
+        :param sink: function consuming the iterator of the items out of the last stage
+        :return: what the sink returns
+        """
+        from concurrent.futures import ProcessPoolExecutor
+
+        queues = [queue.Queue(self.maxsize) for _ in range(len(self.stages) + 1)]
+        consumers = [stage.workers for stage in self.stages] + [1]
+        executors = [
+            ProcessPoolExecutor(stage.workers) if stage.processes else None
+            for stage in self.stages
+        ]
+
+        threads = [threading.Thread(
+            target=self.produce, args=(source, queues[0], consumers[0]), daemon=True
+        )]
+        for i, stage in enumerate(self.stages):
+            running = [stage.workers]
+            threads.extend(
+                threading.Thread(
+                    target=self.work,
+                    args=(stage, executors[i], queues[i], queues[i + 1], consumers[i + 1], running),
+                    daemon=True
+                )
+                for _ in range(stage.workers)
+            )
+        for thread in threads:
+            thread.start()
+
+        try:
+            return sink(self.items(queues[-1]))
+        finally:
+            self.stop.set()
+            for executor in executors:
+                if executor is not None:
+                    executor.shutdown(cancel_futures=True)
+            if self.metrics is not None:
+                self.record()
+
+    def stats(self):
+        """
+        :return: dict stage name -> stats of the stage, in the pipeline's order
+        """
+        return collections.OrderedDict(
+            (step.name, step.stats()) for step in [self.source] + self.stages + [self.sink]
+        )
+
+    def record(self):
+        """
+        Add the stats of the steps to the metrics, as stages and gauges.
+        """
+        for step in [self.source] + self.stages + [self.sink]:
+            self.metrics.add_stage_time('pipeline_{0}'.format(step.name), step.busy)
+            self.metrics.add_stage_time('pipeline_{0}_starved'.format(step.name), step.starved)
+            self.metrics.add_stage_time('pipeline_{0}_blocked'.format(step.name), step.blocked)
+            self.metrics.gauge('pipeline_{0}_queue_max'.format(step.name), step.depth_max)
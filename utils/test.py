@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the transport to the nodes of an ElasticSearch cluster,
+against a fake cluster of stub nodes and a node that can't be reached,
+and of the chunking of csv files on records boundaries.
+"""
+import csv
+import io
+import socket
+import time
+import unittest
+from unittest import mock
+import requests
+from benchmarks.es_stub import ESStub
+from utils import csv_chunks
+from utils.transport import Transport
+
+__author__ = 'guglielmo'
+
+
+def unreachable_url():
+    # a port just released has nobody listening on it
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return "http://127.0.0.1:{0}".format(port)
+
+
+class TransportTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.stubs = [ESStub().start() for _ in range(2)]
+
+    @classmethod
+    def tearDownClass(cls):
+        for stub in cls.stubs:
+            stub.stop()
+
+    def setUp(self):
+        self.dead_url = unreachable_url()
+        self.transport = Transport([self.stubs[0].url, self.dead_url, self.stubs[1].url], timeout=5)
+        self.live, self.dead, self.other = self.transport.nodes
+        # urls of the requests sent, in order
+        self.sent = []
+        request = self.transport.session.request
+
+        def record(method, url, **kwargs):
+            self.sent.append('/'.join(url.split('/')[:3]))
+            return request(method, url, **kwargs)
+
+        patcher = mock.patch.object(self.transport.session, 'request', side_effect=record)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.transport.close)
+
+    def test_round_robin(self):
+        self.assertEqual(
+            [self.transport.select() for _ in range(6)],
+            [self.live, self.dead, self.other] * 2
+        )
+
+    def test_dead_node_skipped(self):
+        for _ in range(4):
+            self.assertEqual(self.transport.get('politici/_count'), {})
+
+        # the request that found the node unreachable went to the next one,
+        # the following ones leave it out
+        self.assertEqual(self.sent, [
+            self.live.url, self.dead.url, self.other.url, self.live.url, self.other.url
+        ])
+        self.assertEqual(self.dead.failures, 1)
+        self.assertEqual(self.live.failures, 0)
+
+    def test_backoff_doubles(self):
+        start = time.time()
+        self.transport.select()
+        self.transport.get('politici/_count')
+        self.assertEqual(self.dead.failures, 1)
+        self.assertAlmostEqual(self.dead.dead_until - start, Transport.dead_backoff, delta=1)
+
+        # once the backoff expires the node is tried again, and left out twice as long
+        self.dead.dead_until = 0.0
+        start = time.time()
+        self.transport.select()
+        self.transport.get('politici/_count')
+        self.assertEqual(self.dead.failures, 2)
+        self.assertAlmostEqual(self.dead.dead_until - start, 2 * Transport.dead_backoff, delta=1)
+
+    def test_backoff_max(self):
+        self.dead.failures = 20
+        start = time.time()
+        self.transport.mark_dead(self.dead)
+        self.assertAlmostEqual(self.dead.dead_until - start, Transport.dead_backoff_max, delta=1)
+
+    def test_mark_alive(self):
+        self.transport.mark_dead(self.live)
+        self.transport.mark_dead(self.live)
+        self.assertEqual(self.live.failures, 2)
+        self.assertNotIn(self.live, [self.transport.select() for _ in range(3)])
+
+        self.transport.mark_alive(self.live)
+        self.assertEqual(self.live.failures, 0)
+        self.assertEqual(self.live.dead_until, 0.0)
+        self.assertIn(self.live, [self.transport.select() for _ in range(3)])
+
+    def test_all_dead(self):
+        for node in self.transport.nodes:
+            self.transport.mark_dead(node)
+        self.live.dead_until -= 0.5
+
+        # the first node to come back is tried anyway
+        self.assertEqual(self.transport.select(), self.live)
+        self.assertEqual(self.transport.get('politici/_count'), {})
+        self.assertEqual(self.live.failures, 0)
+
+    def test_all_unreachable(self):
+        transport = Transport([unreachable_url(), unreachable_url()], timeout=5)
+        self.addCleanup(transport.close)
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            transport.get('politici/_count')
+        self.assertEqual([node.failures for node in transport.nodes], [1, 1])
+
+
+class CsvChunksTest(unittest.TestCase):
+    # quoted values with line breaks, a bare \r among them,
+    # escaped quotes and quotes in unquoted values
+    text = (
+        'a;"b\r\nc";d\r\n'
+        'COSTA D"AVORIO;b"c;"d\n'
+        '"x""\ny";z\n'
+        'a;"b";"c\r'
+        'd"\n'
+        'p;q\n'
+    ) * 3
+
+    def rows(self, lines):
+        return list(csv.reader(lines, delimiter=';'))
+
+    def test_records_not_split(self):
+        expected = self.rows(io.StringIO(self.text, newline=''))
+        for size in range(1, 10):
+            chunks = list(csv_chunks(io.StringIO(self.text, newline=''), size, delimiter=';'))
+            self.assertEqual([row for chunk in chunks for row in self.rows(chunk)], expected, size)
+
+    def test_chunk_size(self):
+        chunks = list(csv_chunks(io.StringIO('a;b\n' * 10, newline=''), 4, delimiter=';'))
+        self.assertEqual([len(chunk) for chunk in chunks], [4, 4, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+import itertools
+import json
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+
+__author__ = 'guglielmo'
+
+
+class Node(object):
+    """
+    An ElasticSearch node, and how long it's considered dead for.
+    """
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.failures = 0
+        self.dead_until = 0.0
+
+    def __repr__(self):
+        return "Node({0})".format(self.url)
+
+
+class Transport(object):
+    """
+    HTTP transport to the nodes of an ElasticSearch cluster.
+
+    Requests go to the nodes in turn, over a pool of keep-alive connections
+    sized for the number of concurrent requests. A node that can't be reached,
+    or doesn't answer in time, is left out for a while, twice as long
+    after each consecutive failure, and the request goes to the next node.
+
+    Responses are parsed from json; error statuses raise HTTPError.
+    """
+
+    # seconds a failing node is left out for, the first time and at most
+    dead_backoff = 1.0
+    dead_backoff_max = 60.0
+
+    def __init__(self, urls, pool_size=10, timeout=60):
+        self.nodes = [Node(url) for url in urls]
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.turns = itertools.count()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=len(self.nodes), pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def select(self):
+        """
+        :return: the next live node; if all are dead, the first to come back
+        """
+        with self.lock:
+            start = next(self.turns)
+            now = time.time()
+            for i in range(len(self.nodes)):
+                node = self.nodes[(start + i) % len(self.nodes)]
+                if node.dead_until <= now:
+                    return node
+            return min(self.nodes, key=lambda node: node.dead_until)
+
+    def mark_dead(self, node):
+        with self.lock:
+            node.failures += 1
+            node.dead_until = time.time() + min(
+                self.dead_backoff_max, self.dead_backoff * 2 ** (node.failures - 1)
+            )
+
+    def mark_alive(self, node):
+        if node.failures:
+            with self.lock:
+                node.failures = 0
+                node.dead_until = 0.0
+
+    def request(self, method, path, data=None, params=None, headers=None, timeout=None):
+        """
+        Send a request to a node, trying the other ones if it can't be reached.
+
+        :param data: dict, sent as json, or bytes, sent as they are
+        :return: the parsed response, None if empty
+        :raise HTTPError: on an error status
+        :raise ConnectionError, Timeout: if no node could answer
+        """
+        if isinstance(data, dict):
+            data = json.dumps(data)
+            headers = dict(headers or {}, **{'Content-Type': 'application/json'})
+
+        error = None
+        for attempt in range(len(self.nodes)):
+            node = self.select()
+            try:
+                r = self.session.request(
+                    method, "{0}/{1}".format(node.url, path.lstrip('/')),
+                    data=data, params=params, headers=headers,
+                    timeout=timeout or self.timeout
+                )
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                self.mark_dead(node)
+                error = e
+                continue
+
+            self.mark_alive(node)
+            r.raise_for_status()
+            return r.json() if r.content else None
+
+        raise error
+
+    def head(self, path, **kwargs):
+        return self.request('HEAD', path, **kwargs)
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.request('PUT', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request('DELETE', path, **kwargs)
+
+    def close(self):
+        self.session.close()